@@ -1,31 +1,27 @@
 import logging
 import logging.config
 import os
-from datetime import timezone
 from pathlib import Path
+from time import perf_counter
 
-import pytz
-import yaml
 from dynaconf import FlaskDynaconf
-from flask import Flask, send_from_directory, session
+from flask import Flask, send_from_directory
 from flask.templating import render_template
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from flask_pagedown import PageDown
 from flask_sqlalchemy import SQLAlchemy
-from flaskext.markdown import Markdown
+from markupsafe import Markup
 
 login_manager = LoginManager()
 login_manager.login_view = "auth_bp.login"
-flask_bcrypt = Bcrypt()
 db = SQLAlchemy()
-pagedown = PageDown()
 markdown = None
 
 
 def create_app():
     """Initialize the Flask app instance"""
 
+    start = perf_counter()
+
     # create the flask app instance
     app = Flask(__name__)
     dynaconf = FlaskDynaconf(extensions_list=True)
@@ -45,10 +41,7 @@ def create_app():
         os.environ["ROOT_PATH_FOR_DYNACONF"] = app.root_path
         dynaconf.init_app(app)
         login_manager.init_app(app)
-        flask_bcrypt.init_app(app)
         db.init_app(app)
-        pagedown.init_app(app)
-        Markdown(app)
         _configure_logging(app, dynaconf)
 
         # import the routes
@@ -59,46 +52,90 @@ def create_app():
         app.register_blueprint(auth.auth_bp)
         app.register_blueprint(content.content_bp)
 
-        # create the database if necessary
-        db.create_all()
+        # register the maintenance commands
+        from .commands import myblog_cli
+
+        app.cli.add_command(myblog_cli)
+
+        # initialize the database if its schema version isn't current,
+        # otherwise only load the roles and settings kept in the process
+        from .schema import init_schema
+
+        init_schema(app)
+
+        # reload the roles when init-db changes them
+        from .principal import init_role_registry
+
+        init_role_registry(app)
+
+        # check the routes against their database query budgets
+        from .query_budget import init_query_budget
+
+        init_query_budget(app)
+
+        # add the template fragment cache
+        from .fragment_cache import init_fragment_cache
 
-        # initialize the role table
-        from .models import Role
+        init_fragment_cache(app)
 
-        Role.initialize_role_table()
+        # size the anonymous user response cache
+        from .response_cache import init_response_cache
+
+        init_response_cache(app)
+
+        # size the pool the passwords are hashed in
+        from .passwords import init_password_pool
+
+        init_password_pool(app)
 
         # register error handlers
         app.register_error_handler(403, error_page)
         app.register_error_handler(404, error_page)
         app.register_error_handler(500, error_page)
 
-        # inject the role permissions class into all template contexts
+        # inject the role permissions class and the registered roles into all template contexts
+        from .models import Role, role_registry
+
         @app.context_processor
         def inject_permissions():
-            return dict(Permissions=Role.Permissions)
+            return dict(Permissions=Role.Permissions, roles=role_registry.roles)
 
-        @app.template_filter()
-        def format_datetime(value, format="%Y-%m-%d %H:%M:%S"):
-            value_with_timezone = value.replace(tzinfo=timezone.utc)
-            tz = pytz.timezone(
-                session.get("timezone_info", {}).get("timeZone", "US/Eastern")
-            )
-            local_now = value_with_timezone.astimezone(tz)
-            return local_now.strftime(format)
+        # the markdown filter converts with the application's markdown
+        # settings, importing markdown when it's first used
+        @app.template_filter("markdown")
+        def markdown_filter(value):
+            from .rendering import render_markdown
+
+            return Markup(render_markdown(value))
+
+        # format dates in the user's timezone
+        from .datetimes import format_datetime, format_datetimes
+
+        app.add_template_filter(format_datetime)
+        app.add_template_filter(format_datetimes)
 
+        app.logger.info(f"MyBlog app created in {(perf_counter() - start) * 1000:.0f}ms")
         return app
 
 
 def _configure_logging(app, dynaconf):
-    # configure logging
+    # configure logging from the settings, or from a logging_config.yaml
+    # file if there is one, yaml is only imported to read the file
     logging_config_path = Path(app.root_path).parent / "logging_config.yaml"
-    with open(logging_config_path, "r") as fh:
-        logging_config = yaml.safe_load(fh.read())
-        env_logging_level = dynaconf.settings.get("logging_level", "INFO").upper()
-        logging_level = logging.INFO if env_logging_level == "INFO" else logging.DEBUG
-        logging_config["handlers"]["console"]["level"] = logging_level
-        logging_config["loggers"][""]["level"] = logging_level
-        logging.config.dictConfig(logging_config)
+    if logging_config_path.exists():
+        import yaml
+
+        with open(logging_config_path, "r") as fh:
+            logging_config = yaml.safe_load(fh.read())
+        root_logger = logging_config["loggers"][""]
+    else:
+        logging_config = dynaconf.settings.get("logging_config").to_dict()
+        root_logger = logging_config["root"]
+    env_logging_level = dynaconf.settings.get("logging_level", "INFO").upper()
+    logging_level = logging.INFO if env_logging_level == "INFO" else logging.DEBUG
+    logging_config["handlers"]["console"]["level"] = logging_level
+    root_logger["level"] = logging_level
+    logging.config.dictConfig(logging_config)
 
 
 def error_page(e):
@@ -12,7 +12,7 @@ from flask import (
 )
 from flask_login.utils import login_required
 from . import auth_bp
-from .. models import db_session_manager, User, Role
+from .. models import db_session_manager, User, role_registry
 from .. import login_manager
 from .forms import (
     LoginForm,
@@ -25,6 +25,12 @@ from .forms import (
 from flask_login import login_user, logout_user, current_user
 from werkzeug.urls import url_parse
 from ..emailer import send_mail
+from ..principal import (
+    cached_principal,
+    forget_principal,
+    is_principal_revoked,
+    remember_principal,
+)
 import json
 
 
@@ -33,8 +39,24 @@ logger = getLogger(__name__)
 
 @login_manager.user_loader
 def load_user(user_id):
+    principal = cached_principal(user_id)
+    if principal is not None:
+        return principal
     with db_session_manager(session_close=False) as db_session:
-        return db_session.get(User, user_id)
+        user = db_session.get(User, user_id)
+    if user is None:
+        return None
+    # was the password changed or the user deactivated since the snapshot?
+    if is_principal_revoked(user):
+        logger.info(f"session of user {user_id} revoked by a security stamp change")
+        forget_principal()
+        session.pop("_user_id", None)
+        session.pop("_fresh", None)
+        # don't log the user back in from their remember me cookie
+        session["_remember"] = "clear"
+        return None
+    remember_principal(user)
+    return user
 
 
 @auth_bp.get("/login")
@@ -60,6 +82,10 @@ def login():
             if user is None or not user.verify_password(form.password.data):
                 flash("Invalid email or password", "warning")
                 return redirect(url_for("auth_bp.login"))
+            # upgrade the password hash if the bcrypt cost setting changed
+            if user.rehash_password(db_session, form.password.data):
+                db_session.commit()
+                logger.info(f"password of user {user.user_uid} hashed again")
             login_user(user, remember=form.remember_me.data)
             session["timezone_info"] = json.loads(form.timezone_info.data)
             next = request.args.get("next")
@@ -86,8 +112,7 @@ def register_new_user():
                 password=form.password.data,
             )
             role_name = "admin" if user.email in current_app.config.get("ADMIN_USERS") else "user"
-            role = db_session.query(Role).filter(Role.name == role_name).one_or_none()
-            role.users.append(user)
+            user.role_uid = role_registry.by_name(role_name).role_uid
             db_session.add(user)
             db_session.commit()
             send_confirmation_email(user)
@@ -110,6 +135,7 @@ def logout():
         redirect: Redirects to the home page
     """
     logout_user()
+    forget_principal()
     session.pop("timezone_info")
     flash("You've been logged out", "light")
     return redirect(url_for("intro_bp.home"))
@@ -121,12 +147,15 @@ def confirm(confirmation_token):
     if current_user.confirmed:
         return redirect(url_for("intro_bp.home"))
     try:
+        # the current user may be a principal snapshot, so load the user to change
+        with db_session_manager(session_close=False) as db_session:
+            user = db_session.get(User, current_user.user_uid)
         # is the confirmation token confirmed?
-        if current_user.confirm_token(confirmation_token):
+        if user.confirm_token(confirmation_token):
             with db_session_manager() as db_session:
-                current_user.confirmation = True
-                db_session.add(current_user)
+                db_session.add(user)
                 db_session.commit()
+                remember_principal(user)
                 flash("Thank you for confirming your account")
     # confirmation token bad or expired
     except Exception as e:
@@ -187,6 +216,8 @@ def profile(user_uid):
         if form.validate_on_submit():
             user.password = form.password.data
             db_session.commit()
+            # keep this session valid with the new security stamp
+            remember_principal(user)
             flash("Your password has been updated")
             return redirect(url_for("intro_bp.home"))
     return render_template("profile.html", form=form)
@@ -0,0 +1,107 @@
+from collections import defaultdict
+from threading import RLock
+
+from cachetools import TTLCache
+
+
+class TaggedCache:
+    """A bounded, thread safe LRU cache with a time to live, where every
+    entry can be tagged so all the entries sharing a tag can be
+    invalidated together. It also keeps hit and miss statistics
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self._lock = RLock()
+        self.configure(maxsize, ttl)
+
+    def configure(self, maxsize, ttl):
+        """Resizes the cache, which also empties it
+
+        Args:
+            maxsize (int): The maximum number of entries in the cache
+            ttl (float): The number of seconds an entry lives in the cache
+        """
+        with self._lock:
+            self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+            self._keys_by_tag = defaultdict(set)
+            self._indexed = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key):
+        """Gets an entry from the cache
+
+        Args:
+            key: The hashable key of the entry
+
+        Returns:
+            The cached value, or None if the key isn't in the cache
+        """
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value, tags=()):
+        """Adds an entry to the cache
+
+        Args:
+            key: The hashable key of the entry
+            value: The value to cache
+            tags (iterable, optional): The tags to invalidate the entry by
+        """
+        with self._lock:
+            self._cache[key] = value
+            for tag in tags:
+                self._keys_by_tag[tag].add(key)
+                self._indexed += 1
+            # drop keys evicted or expired from the cache out of the tag index
+            if self._indexed > 2 * self._cache.maxsize:
+                self._prune()
+
+    def invalidate(self, *tags):
+        """Removes all the entries with any of the tags from the cache
+
+        Args:
+            tags: The tags of the entries to remove
+        """
+        with self._lock:
+            for tag in tags:
+                keys = self._keys_by_tag.pop(tag, ())
+                self._indexed -= len(keys)
+                for key in keys:
+                    self._cache.pop(key, None)
+
+    def clear(self):
+        """Removes all the entries from the cache
+        """
+        with self._lock:
+            self._cache.clear()
+            self._keys_by_tag.clear()
+            self._indexed = 0
+
+    def stats(self):
+        """Gets the statistics of the cache
+
+        Returns:
+            dict: The hits, misses, current size and maximum size of the cache
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": self._cache.currsize,
+                "maxsize": self._cache.maxsize,
+            }
+
+    def _prune(self):
+        self._cache.expire()
+        keys_by_tag = defaultdict(set)
+        for tag, keys in self._keys_by_tag.items():
+            live_keys = {key for key in keys if key in self._cache}
+            if live_keys:
+                keys_by_tag[tag] = live_keys
+        self._keys_by_tag = keys_by_tag
+        self._indexed = sum(len(keys) for keys in keys_by_tag.values())
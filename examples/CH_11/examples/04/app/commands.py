@@ -0,0 +1,1067 @@
+import os
+import random
+import re
+import subprocess
+import sys
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
+from html.parser import HTMLParser
+from threading import Event, Thread
+from pathlib import Path
+from statistics import mean, quantiles
+from time import perf_counter
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, func, or_, String, text, update
+from sqlalchemy.orm import aliased, lazyload
+
+from .counts import thread_stats_values
+from .models import (
+    db_session_manager,
+    get_uuid,
+    Post,
+    Role,
+    SortKeyAllocator,
+    sort_key_allocator,
+    User,
+    user_post,
+)
+from .notifications import flush_pending_notifications, iter_follower_chunks
+from .passwords import PasswordPool, password_pool
+from .schema import add_unique_follows, init_db, SCHEMA_VERSION
+from .rendering import build_excerpt, DEFAULT_MARKDOWN_RENDERER, get_renderer, markdown_key, MARKDOWN_RENDERERS
+
+# the "flask myblog ..." command group for maintaining the MyBlog database
+myblog_cli = AppGroup("myblog", help="MyBlog maintenance commands")
+
+
+@myblog_cli.command("init-db")
+def init_db_command():
+    """Creates the missing tables, adds the missing columns to the existing
+    tables, seeds the lookup tables and stores the schema version, run once
+    per deployment before starting the workers, then run the backfill
+    commands it lists
+    """
+    backfills = init_db(current_app)
+    click.echo(f"database initialized with schema version {SCHEMA_VERSION}")
+    for backfill in backfills:
+        click.echo(f"run 'flask myblog {backfill}' to fill in the columns added to the existing rows")
+
+
+# the modules that are imported on first use, so they mustn't be imported by starting up
+LAZY_MODULES = (
+    "sib_api_v3_sdk",
+    "markdown",
+    "cmarkgfm",
+    "flaskext.markdown",
+    "flask_bcrypt",
+    "bcrypt",
+    "pytz",
+    "yaml",
+)
+
+# the committed markdown documents, with the html the renderers must render them to
+MARKDOWN_CORPUS_DIR = Path(__file__).resolve().parent.parent / "markdown_corpus"
+
+# the script timing a cold start of the application in a new process
+STARTUP_SCRIPT = (
+    "import time; start = time.perf_counter(); "
+    "from app import create_app; create_app(); "
+    "print(f'startup={time.perf_counter() - start}')"
+)
+
+
+def _cold_start(args=(), **env):
+    return subprocess.run(
+        [sys.executable, *args, "-c", STARTUP_SCRIPT],
+        cwd=Path(current_app.root_path).parent,
+        env=dict(os.environ, **env),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def parse_importtime(output):
+    """Parses the "python -X importtime" report of the imports
+
+    Args:
+        output (str): The stderr output of the python process
+
+    Returns:
+        list: The (module, depth, self_us, cumulative_us) of each import,
+            depth 0 is a module imported by the script itself
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+@myblog_cli.command("benchmark-startup")
+@click.option("--runs", default=5, show_default=True, help="Cold starts timed each way")
+@click.option("--top", default=10, show_default=True, help="Slowest imports reported")
+@click.option(
+    "--max-startup-ms",
+    default=None,
+    type=int,
+    help="Fail if a cold start takes longer [default: startup_budget_ms]"
+)
+def benchmark_startup(runs, top, max_startup_ms):
+    """Times cold starts of the application in new processes, skipping the
+    database initialization because the schema version is current, and
+    forcing it on every start the way the application used to start. Then
+    reports the slowest imports from "python -X importtime", and fails if
+    a cold start is over budget or imports a module meant to load lazily
+    """
+    def cold_start_time(force_init_db):
+        output = _cold_start(FLASK_FORCE_INIT_DB=str(force_init_db).lower()).stdout
+        return float(output.rsplit("startup=", 1)[1])
+
+    # the first start initializes the database if necessary
+    cold_start_time(False)
+    startup_ms = None
+    for label, force_init_db in (("schema version current", False), ("init every start", True)):
+        times = [cold_start_time(force_init_db) for _ in range(runs)]
+        click.echo(f"{label}: {mean(times) * 1000:.0f}ms mean, {min(times) * 1000:.0f}ms best of {runs}")
+        startup_ms = startup_ms or mean(times) * 1000
+
+    imports = parse_importtime(_cold_start(["-X", "importtime"]).stderr)
+    # the application's own package is reported as the packages it imports
+    slowest = sorted(
+        (item for item in imports if item[1] <= 1 and item[0] != "app"),
+        key=lambda item: item[3],
+        reverse=True
+    )[:top]
+    click.echo("slowest imports:")
+    for name, depth, self_us, cumulative_us in slowest:
+        click.echo(f"  {cumulative_us / 1000:8.1f}ms  {name}")
+
+    problems = []
+    imported = {name for name, *_ in imports}
+    eager = [name for name in LAZY_MODULES if name in imported]
+    if eager:
+        problems.append(f"lazily loaded modules imported at startup: {', '.join(eager)}")
+    max_startup_ms = max_startup_ms or current_app.config.get("STARTUP_BUDGET_MS")
+    if max_startup_ms is not None and startup_ms > max_startup_ms:
+        problems.append(f"cold start took {startup_ms:.0f}ms, budget is {max_startup_ms}ms")
+    if problems:
+        raise click.ClickException("; ".join(problems))
+
+
+@myblog_cli.command("backfill-excerpts")
+@click.option("--batch-size", default=500, show_default=True, help="Posts updated per transaction")
+@click.option("--all", "all_posts", is_flag=True, help="Rebuild current excerpts too")
+def backfill_excerpts(batch_size, all_posts):
+    """Builds the stored listing excerpts of the root posts that are
+    missing or were built with a different markdown configuration,
+    in batches, without changing their updated time
+    """
+    key = markdown_key()
+    last_post_uid = ""
+    total = 0
+    with db_session_manager() as db_session:
+        while True:
+            posts = (
+                db_session
+                .query(Post.post_uid, Post.content, Post.updated)
+                .filter(Post.parent_uid == None, Post.post_uid > last_post_uid)
+            )
+            if not all_posts:
+                posts = posts.filter(or_(
+                    Post.excerpt_html == None,
+                    Post.excerpt_key == None,
+                    Post.excerpt_key != key
+                ))
+            posts = posts.order_by(Post.post_uid).limit(batch_size).all()
+            if not posts:
+                break
+            mappings = []
+            for post_uid, content, updated in posts:
+                excerpt, excerpt_html = build_excerpt(content)
+                mappings.append({
+                    "post_uid": post_uid,
+                    "excerpt": excerpt,
+                    "excerpt_html": excerpt_html,
+                    "excerpt_key": key,
+                    "updated": updated,
+                })
+            db_session.bulk_update_mappings(Post, mappings)
+            db_session.commit()
+            last_post_uid = posts[-1].post_uid
+            total += len(posts)
+            click.echo(f"{total} post excerpts built")
+    click.echo("done")
+
+
+@myblog_cli.command("backfill-paths")
+@click.option("--batch-size", default=500, show_default=True, help="Posts updated per transaction")
+def backfill_paths(batch_size):
+    """Builds the materialized paths of posts created before posts had
+    paths, a level of the comment threads at a time, without changing
+    their updated time
+    """
+    parent = aliased(Post, name="parent")
+    total = 0
+    with db_session_manager() as db_session:
+        while True:
+            # root posts first, then the comments whose parent has a path
+            posts = (
+                db_session
+                .query(Post.post_uid, Post.sort_key, Post.updated, parent.path)
+                .outerjoin(parent, Post.parent_uid == parent.post_uid)
+                .filter(Post.path == None)
+                .filter((Post.parent_uid == None) | (parent.path != None))
+                .limit(batch_size)
+                .all()
+            )
+            if not posts:
+                break
+            db_session.bulk_update_mappings(Post, [
+                {
+                    "post_uid": post_uid,
+                    "path": (
+                        Post.path_segment(sort_key)
+                        if parent_path is None
+                        else f"{parent_path}.{Post.path_segment(sort_key)}"
+                    ),
+                    "updated": updated,
+                }
+                for post_uid, sort_key, updated, parent_path in posts
+            ])
+            db_session.commit()
+            total += len(posts)
+            click.echo(f"{total} post paths built")
+    click.echo("done")
+
+
+@myblog_cli.command("backfill-root-uids")
+@click.option("--batch-size", default=500, show_default=True, help="Posts updated per transaction")
+def backfill_root_uids(batch_size):
+    """Sets the thread root_uids of posts created before posts had
+    them, a level of the comment threads at a time, without changing
+    their updated time
+    """
+    parent = aliased(Post, name="parent")
+    total = 0
+    with db_session_manager() as db_session:
+        while True:
+            # root posts first, then the comments whose parent has a root_uid
+            posts = (
+                db_session
+                .query(Post.post_uid, Post.parent_uid, Post.updated, parent.root_uid)
+                .outerjoin(parent, Post.parent_uid == parent.post_uid)
+                .filter(Post.root_uid == None)
+                .filter((Post.parent_uid == None) | (parent.root_uid != None))
+                .limit(batch_size)
+                .all()
+            )
+            if not posts:
+                break
+            db_session.bulk_update_mappings(Post, [
+                {
+                    "post_uid": post_uid,
+                    "root_uid": post_uid if parent_uid is None else parent_root_uid,
+                    "updated": updated,
+                }
+                for post_uid, parent_uid, updated, parent_root_uid in posts
+            ])
+            db_session.commit()
+            total += len(posts)
+            click.echo(f"{total} post root_uids set")
+    click.echo("done")
+
+
+@myblog_cli.command("reconcile-thread-stats")
+@click.option("--batch-size", default=500, show_default=True, help="Root posts updated per transaction")
+def reconcile_thread_stats(batch_size):
+    """Recomputes the comment counts and last comment times of the
+    root posts from their comments, without changing their updated time
+    """
+    last_post_uid = ""
+    total = 0
+    with db_session_manager() as db_session:
+        while True:
+            post_uids = [
+                post_uid for (post_uid,) in
+                db_session
+                .query(Post.post_uid)
+                .filter(Post.parent_uid == None, Post.post_uid > last_post_uid)
+                .order_by(Post.post_uid)
+                .limit(batch_size)
+            ]
+            if not post_uids:
+                break
+            db_session.execute(
+                update(Post)
+                .where(Post.post_uid.in_(post_uids))
+                .values(**thread_stats_values(Post.post_uid))
+            )
+            db_session.commit()
+            last_post_uid = post_uids[-1]
+            total += len(post_uids)
+            click.echo(f"{total} thread statistics recomputed")
+    click.echo("done")
+
+
+@myblog_cli.command("dedupe-followers")
+def dedupe_followers():
+    """Removes the duplicate follows from the user_post table of a database
+    created before the table had a primary key and makes the follows
+    unique, which "flask myblog init-db" also does
+    """
+    duplicates = add_unique_follows()
+    click.echo(f"{duplicates} duplicate follows removed")
+    click.echo("done")
+
+
+@myblog_cli.command("check-sort-keys")
+@click.option("--workers", default=4, show_default=True, help="Simulated worker processes")
+@click.option("--threads", default=4, show_default=True, help="Threads per worker")
+@click.option("--posts", default=50, show_default=True, help="Posts inserted per thread")
+def check_sort_keys(workers, threads, posts):
+    """Inserts posts from many threads at once, each thread committing its
+    posts two at a time through its own session and each simulated worker
+    reserving its own blocks of sort_keys in the inserting transaction,
+    after that transaction already wrote the first post. Every tenth
+    transaction is rolled back. Then checks the unique constraint on the
+    sort_keys held, every committed post was stored, and the keys only
+    increased within each thread. The inserted posts are inactive and are
+    deleted afterwards
+    """
+    from sqlalchemy.exc import IntegrityError
+
+    from . import search as search_module
+    from .counts import ALL_ROOT_POSTS
+    from .models import PostCount
+
+    app = current_app._get_current_object()
+    allocators = [SortKeyAllocator(sort_key_allocator.block_size) for _ in range(workers)]
+    with db_session_manager() as db_session:
+        user_uid = db_session.query(User.user_uid).limit(1).scalar()
+    if user_uid is None:
+        raise click.ClickException("a user is needed to author the inserted posts")
+
+    def insert_posts(allocator):
+        inserted, conflicts = [], 0
+        with app.app_context():
+            with db_session_manager() as db_session:
+                for index in range(0, posts, 2):
+                    batch = []
+                    try:
+                        for offset in range(min(2, posts - index)):
+                            post = Post(
+                                user_uid=user_uid,
+                                title=f"check-sort-keys {index + offset}",
+                                content="",
+                                active=False,
+                                sort_key=allocator.allocate(db_session=db_session)[0]
+                            )
+                            db_session.add(post)
+                            # the next key may be reserved after the transaction wrote
+                            db_session.flush()
+                            batch.append(post)
+                        if index // 2 % 10 == 9:
+                            db_session.rollback()
+                            continue
+                        db_session.commit()
+                        allocator.transaction_committed(db_session)
+                    except IntegrityError:
+                        db_session.rollback()
+                        conflicts += 1
+                        continue
+                    finally:
+                        # the session events only inform the app's own allocator
+                        allocator.transaction_ended(db_session)
+                    inserted.extend((post.post_uid, post.sort_key) for post in batch)
+        return inserted, conflicts
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers * threads) as executor:
+            results = list(executor.map(insert_posts, [
+                allocator
+                for allocator in allocators
+                for _ in range(threads)
+            ]))
+        inserted = [post for result, conflicts in results for post in result]
+        post_uids = [post_uid for post_uid, sort_key in inserted]
+        conflicts = sum(conflicts for result, conflicts in results)
+        decreasing = sum(
+            [sort_key for post_uid, sort_key in result] != sorted(sort_key for post_uid, sort_key in result)
+            for result, conflicts in results
+        )
+        with db_session_manager() as db_session:
+            stored = 0
+            for offset in range(0, len(post_uids), 500):
+                stored += (
+                    db_session
+                    .query(Post)
+                    .filter(Post.post_uid.in_(post_uids[offset:offset + 500]))
+                    .count()
+                )
+            duplicates = (
+                db_session
+                .query(Post.sort_key)
+                .group_by(Post.sort_key)
+                .having(func.count() > 1)
+                .count()
+            )
+    finally:
+        # the inserted posts are removed along with what their inserts added,
+        # found by their titles, as a failed thread doesn't return its posts
+        with db_session_manager() as db_session:
+            post_uids = [
+                post_uid
+                for post_uid, in db_session
+                .query(Post.post_uid)
+                .filter(Post.user_uid == user_uid, Post.active == False, Post.title.like("check-sort-keys %"))
+            ]
+            for offset in range(0, len(post_uids), 500):
+                chunk = post_uids[offset:offset + 500]
+                if search_module.fts_enabled:
+                    db_session.execute(
+                        text(
+                            "DELETE FROM post_fts WHERE rowid IN "
+                            "(SELECT rowid FROM post WHERE post_uid IN :post_uids)"
+                        ).bindparams(bindparam("post_uids", expanding=True)),
+                        {"post_uids": chunk}
+                    )
+                db_session.query(Post).filter(Post.post_uid.in_(chunk)).delete(synchronize_session=False)
+            db_session.execute(
+                update(PostCount)
+                .where(PostCount.name == ALL_ROOT_POSTS)
+                .values(value=PostCount.value - len(post_uids))
+            )
+            db_session.commit()
+    click.echo(
+        f"{len(inserted)} posts inserted by {workers * threads} threads, "
+        f"block size {sort_key_allocator.block_size}"
+    )
+    problems = []
+    if conflicts:
+        problems.append(f"{conflicts} inserts conflicted on the unique constraints")
+    if stored != len(inserted):
+        problems.append(f"{len(inserted) - stored} committed posts weren't stored")
+    if duplicates:
+        problems.append(f"{duplicates} duplicate sort_keys stored")
+    if decreasing:
+        problems.append(f"{decreasing} threads got decreasing sort_keys")
+    if problems:
+        raise click.ClickException("; ".join(problems))
+    click.echo("no duplicate sort_keys")
+
+
+@myblog_cli.command("benchmark-notifications")
+@click.option("--followers", default=100000, show_default=True, help="Generated followers of the post")
+@click.option("--chunk-size", default=None, type=int, help="Followers per chunk [default: notification_chunk_size]")
+def benchmark_notifications(followers, chunk_size):
+    """Times streaming the followers of a post to the notification delivery
+    stage, using generated followers that are rolled back afterwards and a
+    delivery stage that doesn't send any email
+    """
+    chunk_size = chunk_size or current_app.config.get("NOTIFICATION_CHUNK_SIZE", 500)
+    with db_session_manager() as db_session:
+        post_uid = db_session.query(Post.post_uid).filter(Post.parent_uid == None).limit(1).scalar()
+        if post_uid is None:
+            raise click.ClickException("a root post is needed to benchmark its followers")
+        role_uid = db_session.query(Role.role_uid).filter(Role.name == "user").scalar()
+        user_uids = [get_uuid() for _ in range(followers)]
+        db_session.execute(User.__table__.insert(), [
+            {
+                "user_uid": user_uid,
+                "role_uid": role_uid,
+                "first_name": "Follower",
+                "last_name": str(index),
+                "email": f"{user_uid}@example.com",
+                "password": "",
+            }
+            for index, user_uid in enumerate(user_uids)
+        ])
+        db_session.execute(user_post.insert(), [
+            {"user_uid": user_uid, "post_uid": post_uid}
+            for user_uid in user_uids
+        ])
+        try:
+            tracemalloc.start()
+            start = perf_counter()
+            chunks = notified = 0
+            for chunk in iter_follower_chunks(db_session, post_uid, chunk_size):
+                chunks += 1
+                notified += len(chunk)
+            elapsed = perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            db_session.rollback()
+    click.echo(
+        f"{notified} followers streamed in {chunks} chunks of {chunk_size} in {elapsed:.2f}s, "
+        f"peak memory {peak / 1024 / 1024:.1f} MiB"
+    )
+
+
+@myblog_cli.command("flush-notifications")
+def flush_notifications():
+    """Sends the comment notification digests whose window has passed,
+    run periodically, ex: from cron, when notification_mode is "digest"
+    """
+    click.echo(f"{flush_pending_notifications()} digest notifications sent")
+
+
+@myblog_cli.command("benchmark-permissions")
+@click.option("--comments", default=500, show_default=True, help="Comments in the generated thread")
+@click.option("--repeat", default=20, show_default=True, help="Times the thread's checks are run")
+@click.option("--email", default=None, help="The user to check as [default: the first user]")
+def benchmark_permissions(comments, repeat, email):
+    """Times the permission checks the templates make when rendering
+    a thread of comments, for a user logged in for the request
+    """
+    from flask_login import login_user
+
+    from .content.content import utility_processor
+
+    with db_session_manager() as db_session:
+        user = db_session.query(User)
+        if email is not None:
+            user = user.filter(User.email == email)
+        user = user.first()
+        if user is None:
+            raise click.ClickException("a user is needed to check the permissions of")
+        thread = [Post(post_uid=get_uuid(), user_uid=get_uuid()) for _ in range(comments)]
+        with current_app.test_request_context():
+            login_user(user)
+            checks = utility_processor()
+            start = perf_counter()
+            for _ in range(repeat):
+                for post in thread:
+                    checks["can_update_blog_post"](post)
+                    checks["can_set_blog_post_active_state"](post)
+            elapsed = perf_counter() - start
+    per_thread = elapsed / repeat
+    click.echo(
+        f"{comments} comment thread checked in {per_thread * 1000:.2f}ms, "
+        f"{per_thread / (comments * 2) * 1000000:.2f}us per check"
+    )
+
+
+class _CanonicalHtml(HTMLParser):
+    # rebuilds the html with its attributes sorted and its text escaped the same way
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = "".join(f' {name}="{escape(value or "")}"' for name, value in sorted(attrs))
+        self.parts.append(f"<{tag}{attrs}>")
+
+    def handle_endtag(self, tag):
+        self.parts.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        self.parts.append(escape(data))
+
+
+def normalize_html(html):
+    """Normalizes the whitespace between html tags and before closing tags,
+    the self closing tags, the order of the attributes and the escaping of
+    the text, which the markdown renderers emit differently without
+    changing the page
+
+    Args:
+        html (str): The html to normalize
+
+    Returns:
+        str: The normalized html
+    """
+    parser = _CanonicalHtml()
+    parser.feed(html)
+    parser.close()
+    html = "".join(parser.parts)
+    html = re.sub(r">\s+<", "><", html)
+    return re.sub(r"\s+</", "</", html).strip()
+
+
+def _markdown_corpus(corpus_dir, limit):
+    if corpus_dir is not None:
+        paths = sorted(Path(corpus_dir).glob("*.md"))[:limit]
+        return [(path.name, path.read_text(encoding="utf-8")) for path in paths]
+    with db_session_manager() as db_session:
+        posts = (
+            db_session
+            .query(Post.post_uid, Post.content)
+            .filter(Post.content != None)
+            .order_by(Post.post_uid)
+            .limit(limit)
+            .all()
+        )
+    return [(post_uid, content) for post_uid, content in posts]
+
+
+@myblog_cli.command("benchmark-markdown")
+@click.option(
+    "--renderer",
+    "renderers",
+    multiple=True,
+    type=click.Choice(sorted(MARKDOWN_RENDERERS)),
+    help="Renderers timed [default: all]"
+)
+@click.option(
+    "--corpus",
+    "corpus_dir",
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+    help="Directory of .md files to render [default: the posts in the database]"
+)
+@click.option("--limit", default=1000, show_default=True, help="Most documents rendered")
+@click.option("--repeat", default=5, show_default=True, help="Times the corpus is rendered by each renderer")
+def benchmark_markdown(renderers, corpus_dir, limit, repeat):
+    """Times rendering the posts, or a directory of markdown documents, with
+    each markdown renderer and counts the documents whose html differs from
+    the html of the default renderer the stored post html was rendered with,
+    to try a renderer on the posts before choosing it with the
+    markdown_renderer setting
+    """
+    corpus = _markdown_corpus(corpus_dir, limit)
+    if not corpus:
+        raise click.ClickException("no markdown documents to render")
+    characters = sum(len(content) for _, content in corpus)
+    click.echo(f"{len(corpus)} documents, {characters} characters")
+
+    reference = get_renderer(DEFAULT_MARKDOWN_RENDERER)
+    expected = [normalize_html(reference.render(content)) for _, content in corpus]
+    for name in renderers or sorted(MARKDOWN_RENDERERS):
+        renderer = get_renderer(name)
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            html = [renderer.render(content) for _, content in corpus]
+            times.append(perf_counter() - start)
+        best = min(times)
+        differing = sum(
+            expected_html != normalize_html(actual_html)
+            for expected_html, actual_html in zip(expected, html)
+        )
+        click.echo(
+            f"{name} {renderer.version()}: {best * 1000:.1f}ms best of {repeat}, "
+            f"{characters / best / 1000000:.2f}M characters/s, "
+            f"{differing} documents differ from {reference.name}"
+        )
+
+
+@myblog_cli.command("check-markdown")
+@click.option(
+    "--renderer",
+    "renderers",
+    multiple=True,
+    type=click.Choice(sorted(MARKDOWN_RENDERERS)),
+    help="Renderers checked [default: all]"
+)
+def check_markdown(renderers):
+    """Renders the committed corpus of markdown documents with each markdown
+    renderer, without extensions, and fails if the html of any document
+    differs from its .html file, the html python-markdown renders. A
+    document CommonMark renders differently has a .commonmark.html file
+    too, which the CommonMark renderers are held to instead
+    """
+    corpus = sorted(MARKDOWN_CORPUS_DIR.glob("*.md"))
+    if not corpus:
+        raise click.ClickException(f"no markdown documents in {MARKDOWN_CORPUS_DIR}")
+    renderers = renderers or sorted(MARKDOWN_RENDERERS)
+    failures = []
+    for name in renderers:
+        renderer = get_renderer(name, extensions=[])
+        for path in corpus:
+            expected_path = path.with_name(f"{path.stem}.html")
+            commonmark_path = path.with_name(f"{path.stem}.commonmark.html")
+            if renderer.commonmark and commonmark_path.exists():
+                expected_path = commonmark_path
+            expected = normalize_html(expected_path.read_text(encoding="utf-8"))
+            actual = normalize_html(renderer.render(path.read_text(encoding="utf-8")))
+            if actual != expected:
+                failures.append(
+                    f"{name}: {path.name} differs from {expected_path.name}\n"
+                    f"    expected: {expected[:200]}\n    actual: {actual[:200]}"
+                )
+    click.echo(f"{len(corpus)} documents rendered by {', '.join(renderers)}")
+    if failures:
+        raise click.ClickException("\n".join(failures))
+    click.echo("the html of every document is the expected html")
+
+
+def _page_view_probe(stop, latencies):
+    # stands in for the pages the worker serves while the logins run
+    while not stop.is_set():
+        start = perf_counter()
+        sum(i * i for i in range(20000))
+        latencies.append(perf_counter() - start)
+
+
+@myblog_cli.command("benchmark-logins")
+@click.option("--logins", default=64, show_default=True, help="Password checks in each burst")
+@click.option("--concurrency", default=16, show_default=True, help="Request threads logging in at once")
+@click.option("--rounds", default=None, type=int, help="The bcrypt cost [default: bcrypt_log_rounds]")
+def benchmark_logins(logins, concurrency, rounds):
+    """Times a burst of concurrent logins checking their passwords in the
+    request threads, then in the password pool, measuring the login
+    throughput and how much the burst slows down the other requests
+    """
+    rounds = rounds or password_pool.log_rounds
+    workers = password_pool.workers or os.cpu_count()
+    modes = (("request threads", 0), (f"password pool of {workers}", workers))
+    for label, mode_workers in modes:
+        pool = PasswordPool(
+            workers=mode_workers,
+            max_pending=concurrency,
+            timeout=password_pool.timeout * logins,
+            log_rounds=rounds
+        )
+        hashed_password = pool.hash_password("benchmark password")
+        # start all the pool's worker processes before timing it
+        with ThreadPoolExecutor(max_workers=max(1, mode_workers)) as executor:
+            list(executor.map(
+                lambda _: pool.check_password(hashed_password, "benchmark password"),
+                range(max(1, mode_workers))
+            ))
+
+        def login(_):
+            start = perf_counter()
+            if not pool.check_password(hashed_password, "benchmark password"):
+                raise click.ClickException("benchmark password not verified")
+            return perf_counter() - start
+
+        stop = Event()
+        probe_latencies = []
+        probe = Thread(target=_page_view_probe, args=(stop, probe_latencies), daemon=True)
+        probe.start()
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(login, range(logins)))
+        elapsed = perf_counter() - start
+        stop.set()
+        probe.join()
+        pool.shutdown()
+        stats = pool.stats()
+        click.echo(
+            f"{label}: {logins / elapsed:.1f} logins/s, "
+            f"login p50 {quantiles(latencies, n=100)[49] * 1000:.0f}ms "
+            f"p95 {quantiles(latencies, n=100)[94] * 1000:.0f}ms, "
+            f"page view mean {mean(probe_latencies or [0]) * 1000:.1f}ms, "
+            f"peak queue {stats['peak_pending']} of {stats['max_pending']}"
+        )
+    # the unloaded cost of a page view, to compare the bursts with
+    stop = Event()
+    idle_latencies = []
+    probe = Thread(target=_page_view_probe, args=(stop, idle_latencies), daemon=True)
+    probe.start()
+    Event().wait(0.5)
+    stop.set()
+    probe.join()
+    click.echo(f"idle page view mean {mean(idle_latencies) * 1000:.1f}ms, bcrypt cost {rounds}")
+
+
+@myblog_cli.command("check-query-budgets")
+@click.option("--email", default=None, help="Check the pages as this user [default: anonymously]")
+def check_query_budgets(email):
+    """Requests the pages of the routes with a GET query budget, with the
+    response and fragment caches empty, and fails if any of them runs
+    more database queries than its budget
+    """
+    from flask import url_for
+
+    from .fragment_cache import fragment_cache
+    from .query_budget import assert_query_budget, QueryBudgetExceeded
+    from .response_cache import response_cache
+
+    with db_session_manager() as db_session:
+        # the thread with the most comments is the most expensive to show
+        post_uid = (
+            db_session
+            .query(Post.post_uid)
+            .filter(Post.parent_uid == None, Post.active == True)
+            .order_by(Post.comment_count.desc())
+            .limit(1)
+            .scalar()
+        )
+        user_uid = None
+        if email is not None:
+            user_uid = db_session.query(User.user_uid).filter(User.email == email).scalar()
+            if user_uid is None:
+                raise click.ClickException(f"unknown user {email}")
+    if post_uid is None:
+        raise click.ClickException("an active post is needed to request the pages of")
+    with current_app.test_request_context():
+        urls = {
+            "content_bp.blog_posts": url_for("content_bp.blog_posts"),
+            "content_bp.blog_post": url_for("content_bp.blog_post", post_uid=post_uid),
+            "content_bp.blog_post_comments": url_for("content_bp.blog_post_comments", post_uid=post_uid),
+        }
+    client = current_app.test_client()
+    if user_uid is not None:
+        with client.session_transaction() as session:
+            session["_user_id"] = user_uid
+            session["_fresh"] = True
+    over_budget = []
+    for key, budget in sorted(current_app.config.get("QUERY_BUDGETS", {}).items()):
+        method, endpoint = key.split(" ", 1)
+        if method != "GET" or endpoint not in urls:
+            click.echo(f"{key}: no page to request, skipped")
+            continue
+        response_cache.clear()
+        fragment_cache.clear()
+        try:
+            with assert_query_budget(budget) as counter:
+                status = client.get(urls[endpoint]).status_code
+            click.echo(f"{key}: {counter.count} queries, budget {budget}, status {status}")
+        except QueryBudgetExceeded as e:
+            click.echo(f"{key}: {e}")
+            over_budget.append(key)
+    if over_budget:
+        raise click.ClickException(f"over their query budget: {', '.join(over_budget)}")
+
+
+@myblog_cli.command("benchmark-search")
+@click.option("--posts", default=100000, show_default=True, help="Generated root posts to search")
+@click.option("--words", default=60, show_default=True, help="Words in each generated post's content")
+@click.option("--searches", default=20, show_default=True, help="Searches timed each way")
+def benchmark_search(posts, words, searches):
+    """Times searching the posts with the FTS5 index against the LIKE
+    queries it replaced, using generated posts that are rolled back
+    afterwards, ex: "--posts 1000000" for a million posts
+    """
+    from . import search as search_module
+    from .search import search_posts
+
+    if not search_module.fts_enabled:
+        raise click.ClickException("the full text search index isn't available")
+    rng = random.Random(0)
+    vocabulary = [f"word{index}" for index in range(20000)]
+    per_page = current_app.config.get("BLOG_POSTS_PER_PAGE", 10)
+    with db_session_manager() as db_session:
+        user_uid = db_session.query(User.user_uid).limit(1).scalar()
+        if user_uid is None:
+            raise click.ClickException("a user is needed to author the generated posts")
+        start = perf_counter()
+        batch_size = 10000
+        for offset in range(0, posts, batch_size):
+            # negative sort_keys can't collide with the real posts' keys
+            db_session.execute(Post.__table__.insert(), [
+                {
+                    "post_uid": get_uuid(),
+                    "user_uid": user_uid,
+                    "sort_key": -1 - index,
+                    "title": " ".join(rng.choices(vocabulary, k=5)),
+                    "content": " ".join(rng.choices(vocabulary, k=words)),
+                    "active": True,
+                }
+                for index in range(offset, min(offset + batch_size, posts))
+            ])
+        db_session.execute(text(
+            "INSERT INTO post_fts(rowid, post_uid, title, content) "
+            "SELECT rowid, post_uid, title, content FROM post WHERE sort_key < 0"
+        ))
+        click.echo(f"{posts} posts generated in {perf_counter() - start:.1f}s")
+        terms = rng.choices(vocabulary, k=searches)
+        query = db_session.query(Post).filter(Post.parent_uid == None, Post.active == True)
+        try:
+            for label, use_index in (("FTS5 index", True), ("LIKE", False)):
+                search_module.fts_enabled = use_index
+                times = []
+                for term in terms:
+                    start = perf_counter()
+                    search_posts(query, term).limit(per_page).all()
+                    times.append(perf_counter() - start)
+                click.echo(
+                    f"{label}: {mean(times) * 1000:.1f}ms mean, "
+                    f"{max(times) * 1000:.1f}ms slowest of {searches} searches"
+                )
+        finally:
+            search_module.fts_enabled = True
+            db_session.rollback()
+
+
+@myblog_cli.command("benchmark-pagination")
+@click.option("--posts", default=200000, show_default=True, help="Generated root posts to page through")
+@click.option("--page", "deep_page", default=10000, show_default=True, help="The deep page compared with the first")
+@click.option("--repeat", default=20, show_default=True, help="Times each page is queried")
+def benchmark_pagination(posts, deep_page, repeat):
+    """Times getting the first and a deep page of the blog posts listing by
+    keyset cursor and by offset, for the viewers of only active posts and
+    of all posts, using generated posts that are rolled back afterwards
+    """
+    from datetime import datetime, timedelta
+
+    from .pagination import encode_cursor, keyset_paginate
+
+    per_page = current_app.config.get("BLOG_POSTS_PER_PAGE", 10)
+    if deep_page * per_page > posts:
+        raise click.ClickException(f"{posts} posts don't fill {deep_page} pages of {per_page}")
+    with db_session_manager() as db_session:
+        user_uid = db_session.query(User.user_uid).limit(1).scalar()
+        if user_uid is None:
+            raise click.ClickException("a user is needed to author the generated posts")
+        now = datetime.now()
+        batch_size = 10000
+        for offset in range(0, posts, batch_size):
+            # negative sort_keys can't collide with the real posts' keys
+            db_session.execute(Post.__table__.insert(), [
+                {
+                    "post_uid": get_uuid(),
+                    "user_uid": user_uid,
+                    "sort_key": -1 - index,
+                    "title": f"post {index}",
+                    "active": index % 10 != 0,
+                    # a few posts share an updated time to exercise the post_uid tie break
+                    "updated": now - timedelta(seconds=index // 3),
+                }
+                for index in range(offset, min(offset + batch_size, posts))
+            ])
+        click.echo(f"{posts} posts generated, {per_page} posts per page")
+
+        def timed(get_page):
+            start = perf_counter()
+            for _ in range(repeat):
+                get_page()
+            return (perf_counter() - start) / repeat * 1000
+
+        try:
+            for label, active_only in (("active posts", True), ("all posts", False)):
+                query = db_session.query(Post).filter(Post.parent_uid == None)
+                if active_only:
+                    query = query.filter(Post.active == True)
+                ordered = query.order_by(Post.updated.desc(), Post.post_uid.desc())
+                # the cursor of the deep page is the position of the post before it
+                position = (
+                    ordered
+                    .with_entities(Post.updated, Post.post_uid)
+                    .offset((deep_page - 1) * per_page - 1)
+                    .limit(1)
+                    .one()
+                )
+                cursor = encode_cursor("next", *position)
+                keyset_first = timed(lambda: keyset_paginate(query, Post.updated, Post.post_uid, per_page))
+                keyset_deep = timed(lambda: keyset_paginate(query, Post.updated, Post.post_uid, per_page, cursor))
+                offset_first = timed(lambda: ordered.limit(per_page).all())
+                offset_deep = timed(lambda: ordered.offset((deep_page - 1) * per_page).limit(per_page).all())
+                click.echo(
+                    f"{label}: keyset page 1 {keyset_first:.2f}ms, page {deep_page} {keyset_deep:.2f}ms; "
+                    f"offset page 1 {offset_first:.2f}ms, page {deep_page} {offset_deep:.2f}ms"
+                )
+        finally:
+            db_session.rollback()
+
+
+def _thread_cte_query(db_session, post_uid):
+    """Creates the recursive CTE query the thread of a post was loaded
+    with before posts had paths, to compare the path range scan with
+
+    Args:
+        db_session: The database session to use
+        post_uid (str): The post_uid of the root post
+
+    Returns:
+        Query: The query of the (Post, sorting_key) tuples of the thread
+    """
+    hierarchy = (
+        db_session
+        .query(Post, Post.sort_key.label("sorting_key"))
+        .filter(Post.post_uid == post_uid, Post.parent_uid == None)
+        .cte(name="hierarchy", recursive=True)
+    )
+    children = aliased(Post, name="c")
+    hierarchy = hierarchy.union_all(
+        db_session
+        .query(
+            children,
+            (
+                func.cast(hierarchy.c.sorting_key, String) +
+                " " +
+                func.cast(children.sort_key, String)
+            ).label("sorting_key")
+        )
+        .filter(children.parent_uid == hierarchy.c.post_uid)
+    )
+    return (
+        db_session
+        .query(Post, func.cast(hierarchy.c.sorting_key, String))
+        .options(lazyload(Post.user), lazyload(Post.parent))
+        .select_entity_from(hierarchy)
+        .order_by(hierarchy.c.sorting_key)
+    )
+
+
+@myblog_cli.command("benchmark-threads")
+@click.option(
+    "--sizes",
+    default="10,1000,100000",
+    show_default=True,
+    help="Comma separated numbers of comments in the generated threads"
+)
+@click.option("--repeat", default=5, show_default=True, help="Times each thread is loaded each way")
+def benchmark_threads(sizes, repeat):
+    """Times loading a whole comment thread with the recursive CTE query it
+    replaced and with the path range scan, using generated threads, where
+    each comment replies to a random earlier post of the thread, that are
+    rolled back afterwards
+    """
+    rng = random.Random(0)
+    with db_session_manager() as db_session:
+        user_uid = db_session.query(User.user_uid).limit(1).scalar()
+        if user_uid is None:
+            raise click.ClickException("a user is needed to author the generated threads")
+        sort_key = 0
+        try:
+            for size in (int(size) for size in sizes.split(",")):
+                posts = []
+                for index in range(size + 1):
+                    # negative sort_keys can't collide with the real posts' keys
+                    sort_key -= 1
+                    parent = rng.choice(posts) if posts else None
+                    segment = Post.path_segment(sort_key)
+                    posts.append({
+                        "post_uid": get_uuid(),
+                        "parent_uid": parent and parent["post_uid"],
+                        "root_uid": parent["root_uid"] if parent else None,
+                        "user_uid": user_uid,
+                        "sort_key": sort_key,
+                        "path": f"{parent['path']}.{segment}" if parent else segment,
+                        "content": f"comment {index}",
+                    })
+                    if parent is None:
+                        posts[0]["root_uid"] = posts[0]["post_uid"]
+                db_session.execute(Post.__table__.insert(), posts)
+                root = posts[0]
+                start, end = Post.thread_path_range(root["path"])
+                path_query = (
+                    db_session
+                    .query(Post)
+                    .options(lazyload(Post.user), lazyload(Post.parent))
+                    .filter(Post.path >= start, Post.path < end)
+                    .order_by(Post.path)
+                )
+                cte_query = _thread_cte_query(db_session, root["post_uid"])
+                times = {}
+                for label, query in (("recursive CTE", cte_query), ("path range", path_query)):
+                    elapsed = []
+                    for _ in range(repeat):
+                        db_session.expunge_all()
+                        started = perf_counter()
+                        loaded = len(query.all())
+                        elapsed.append(perf_counter() - started)
+                    if loaded != size + 1:
+                        raise click.ClickException(f"{label} loaded {loaded} of the {size + 1} posts")
+                    times[label] = min(elapsed) * 1000
+                click.echo(
+                    f"{size} comments: " +
+                    ", ".join(f"{label} {elapsed:.1f}ms" for label, elapsed in times.items()) +
+                    f", best of {repeat}"
+                )
+        finally:
+            db_session.rollback()
@@ -0,0 +1,95 @@
+import hashlib
+from datetime import datetime, timezone
+from http import HTTPStatus
+from time import time
+
+from flask import current_app, make_response, request, session
+
+from .permissions import current_permissions, viewer_permission_class
+
+
+def set_cache_control(response):
+    """Sets the caching policy of a content page, anonymous users all
+    see the same page so shared caches can keep it, logged in users
+    see their own page so only their browser can keep it
+
+    Args:
+        response (Response): The response to set the caching headers of
+    """
+    if current_permissions().is_anonymous:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get("CONDITIONAL_GET_MAX_AGE", 0)
+        response.cache_control.must_revalidate = True
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+
+
+def csrf_token_period():
+    """Gets the start of the current period of CSRF token lifetimes, a
+    page rendered within the period has a CSRF token valid for at least
+    half the token time limit from any time within the period
+
+    Returns:
+        datetime: The start of the period, or None if the tokens don't expire
+    """
+    if not current_app.config.get("WTF_CSRF_ENABLED", True):
+        return None
+    time_limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    if not time_limit:
+        return None
+    period = time_limit / 2
+    return datetime.fromtimestamp(time() // period * period, timezone.utc)
+
+
+def conditional_response(last_modified, render, *validators, forms=False):
+    """Creates the response of a content page with ETag and Last-Modified
+    validators, returning 304 Not Modified without rendering the page if
+    the client already has the current version of it
+
+    Args:
+        last_modified (datetime): The most recent updated time of the content on the page
+        render (function): Renders the page when the client needs it
+        validators: Any other values that change when the page content changes
+        forms (bool): True if the page renders forms with CSRF tokens, which
+            expire, so the page is revalidated at most half the token time
+            limit after it was rendered
+
+    Returns:
+        Response: The rendered page or a 304 Not Modified response
+    """
+    # pending flash messages are part of the page, so it can't be reused
+    if "_flashes" in session:
+        response = make_response(render())
+        set_cache_control(response)
+        return response
+
+    last_modified = (last_modified or datetime.fromtimestamp(0)).replace(tzinfo=timezone.utc, microsecond=0)
+    # the page changes when its CSRF tokens would have to be renewed
+    token_period = csrf_token_period() if forms else None
+    if token_period is not None:
+        last_modified = max(last_modified, token_period)
+    etag = hashlib.sha1(repr((
+        last_modified.isoformat(),
+        viewer_permission_class(),
+        current_permissions().user_uid,
+        session.get("timezone_info", {}).get("timeZone"),
+        validators,
+    )).encode("utf-8")).hexdigest()
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif request.if_modified_since is not None:
+        not_modified = last_modified <= request.if_modified_since
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = make_response("", HTTPStatus.NOT_MODIFIED)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    set_cache_control(response)
+    return response
@@ -12,12 +12,28 @@ from logging import getLogger
 from . import content_bp
 from ..models import (
     db_session_manager,
+    dialect_insert,
     Post,
     db,
-    Role,
-    User,
+    user_post,
+)
+from ..notifications import notify_followers
+from ..pagination import keyset_paginate, InvalidCursor, KeysetPagination
+from ..search import search_posts, attach_snippets
+from ..rendering import build_excerpt, content_key, markdown_key, render_content
+from ..conditional import conditional_response
+from ..permissions import current_permissions
+from ..response_cache import (
+    cache_anonymous_response,
+    tag_response,
+    POSTS_LISTING_TAG,
+)
+from ..counts import (
+    paginate_counted,
+    get_post_count,
+    ACTIVE_ROOT_POSTS,
+    ALL_ROOT_POSTS,
 )
-from ..emailer import send_mail
 from flask_login import current_user
 from flask_login import login_required
 from .forms import (
@@ -25,9 +41,9 @@ from .forms import (
     PostUpdateForm,
     PostCommentForm,
 )
-from sqlalchemy.orm import aliased
-from sqlalchemy.sql.expression import func
-from sqlalchemy.types import String
+from sqlalchemy import func, update
+from sqlalchemy.orm import load_only, lazyload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 logger = getLogger(__name__)
@@ -35,6 +51,7 @@ logger = getLogger(__name__)
 
 @content_bp.get("/blog_posts")
 @content_bp.post("/blog_posts")
+@cache_anonymous_response
 def blog_posts():
     """This function dispatches control to the correct handler
     based on the URL and the query string
@@ -58,30 +75,83 @@ def blog_posts_display():
         text: the rendered HTML for the page
     """
     logger.debug("rendering blog posts page")
-    search = request.args.get("search")
+    search = request.args.get("search", "").strip() or None
     with db_session_manager() as db_session:
         page = request.args.get("page", type=int)
         posts = (
             db_session
             .query(Post)
+            .options(
+                load_only(
+                    Post.post_uid,
+                    Post.user_uid,
+                    Post.title,
+                    Post.excerpt_html,
+                    Post.excerpt_key,
+                    Post.active,
+                    Post.updated,
+                    Post.comment_count,
+                    Post.last_comment_at,
+                ),
+                lazyload(Post.parent),
+                lazyload(Post.user),
+            )
             .filter(Post.parent_uid == None)
-            .order_by(Post.updated.desc())
         )
         # can the current user view only active posts:
-        if current_user.is_anonymous or current_user.can_view_posts():
+        count_name = ALL_ROOT_POSTS
+        if current_permissions().views_active_posts_only:
             posts = posts.filter(Post.active == True)
-
-        # is the user searching for content in the posts?
+            count_name = ACTIVE_ROOT_POSTS
+
+        # are the most recently commented on threads listed first?
+        sort_column = Post.updated
+        if request.args.get("sort") == "activity":
+            posts = posts.filter(Post.last_comment_at != None)
+            sort_column = Post.last_comment_at
+            count_name = None
+
+        # is the user searching for content in the posts? search results
+        # are ranked by relevance, so they're always paged by page number
+        # and their total is approximate
         if search is not None:
-            posts = posts.filter(Post.content.like(f"%{search}%"))
-        posts = (
-            posts.paginate(
+            posts = paginate_counted(
+                search_posts(posts, search),
+                page=page,
+                per_page=current_app.config["BLOG_POSTS_PER_PAGE"]
+            )
+            posts.items = attach_snippets(posts.items)
+
+        # is the listing paged by cursor instead of by page number?
+        elif current_app.config.get("BLOG_POSTS_PAGINATION", "offset") == "keyset":
+            try:
+                posts = keyset_paginate(
+                    posts,
+                    sort_column,
+                    Post.post_uid,
+                    per_page=current_app.config["BLOG_POSTS_PER_PAGE"],
+                    cursor=request.args.get("cursor")
+                )
+            except InvalidCursor:
+                abort(HTTPStatus.BAD_REQUEST)
+        else:
+            posts = paginate_counted(
+                posts.order_by(sort_column.desc()),
                 page=page,
                 per_page=current_app.config["BLOG_POSTS_PER_PAGE"],
-                error_out=False
+                total=get_post_count(db_session, count_name) if count_name is not None else None
             )
-        )
-    return render_template("posts.html", posts=posts)
+        _ensure_excerpts(db_session, posts.items)
+    tag_response(POSTS_LISTING_TAG)
+    return conditional_response(
+        max(
+            (max(post.updated, post.last_comment_at or post.updated) for post in posts.items),
+            default=None
+        ),
+        lambda: render_template("posts.html", posts=posts),
+        [(post.post_uid, post.comment_count) for post in posts.items],
+        getattr(posts, "total", None)
+    )
 
 
 @login_required
@@ -102,6 +172,8 @@ def blog_post_create():
                 title=form.title.data.strip(),
                 content=form.content.data.strip(),
             )
+            post.update_excerpt()
+            post.update_content_html()
             db_session.add(post)
             db_session.commit()
             flash(f"Blog post '{form.title.data.strip()}' created")
@@ -114,6 +186,7 @@ def blog_post_create():
 
 @content_bp.get("/blog_posts/<post_uid>")
 @content_bp.post("/blog_posts/<post_uid>")
+@cache_anonymous_response
 def blog_post(post_uid=None):
     """This function dispatches control to the correct handler
     based on the URL and the query string
@@ -140,11 +213,88 @@ def blog_post_display(post_uid):
     logger.debug("rendering blog post page")
     form = PostCommentForm()
     with db_session_manager() as db_session:
+        # are the comments loaded a page at a time?
+        if current_app.config.get("BLOG_POST_LAZY_COMMENTS", False):
+            return _blog_post_display_lazy(db_session, form, post_uid)
         posts = _build_posts_hierarchy(db_session, post_uid)
         if posts is None:
             flash(f"Unknown post uid: {post_uid}")
             abort(HTTPStatus.NOT_FOUND)
-        return render_template("post.html", form=form, posts=posts)
+        _ensure_content_html(db_session, posts[0][0])
+        tag_response(*(post.post_uid for post, sorting_key in posts))
+        return conditional_response(
+            max(post.updated for post, sorting_key in posts),
+            lambda: render_template("post.html", form=form, posts=posts),
+            len(posts),
+            # only logged in users get the comment form
+            forms=not current_user.is_anonymous
+        )
+
+
+def _blog_post_display_lazy(db_session, form, post_uid):
+    """Presents a blog post with only the first page of its top level
+    comments, the rest of the comments and their replies are fetched
+    by the page from the blog_post_comments endpoint
+
+    Returns:
+        text: the rendered HTML for the page
+    """
+    root_post = _root_post_query(db_session, post_uid).one_or_none()
+    if root_post is None:
+        flash(f"Unknown post uid: {post_uid}")
+        abort(HTTPStatus.NOT_FOUND)
+    _ensure_content_html(db_session, root_post)
+    comments = _get_comments_page(db_session, root_post.post_uid)
+    tag_response(root_post.post_uid, *(post.post_uid for post, child_count in comments.items))
+    return conditional_response(
+        max([root_post.updated] + [post.updated for post, child_count in comments.items]),
+        lambda: render_template(
+            "post.html",
+            form=form,
+            posts=[(root_post, root_post.path)],
+            comments=comments,
+            root_post_uid=root_post.post_uid,
+            parent_uid=root_post.post_uid,
+        ),
+        [(post.post_uid, child_count) for post, child_count in comments.items],
+        # comments past the first page change whether there's a next page
+        root_post.comment_count,
+        comments.next_cursor,
+        # only logged in users get the comment form
+        forms=not current_user.is_anonymous
+    )
+
+
+@content_bp.get("/blog_posts/<post_uid>/comments")
+@cache_anonymous_response
+def blog_post_comments(post_uid):
+    """Presents a page of the comments on a post or comment in
+    a thread as an HTML fragment to add to the blog post page
+
+    Returns:
+        text: the rendered HTML fragment
+    """
+    logger.debug("rendering blog post comments fragment")
+    parent_uid = request.args.get("parent_uid", post_uid)
+    with db_session_manager() as db_session:
+        if _root_post_query(db_session, post_uid).with_entities(Post.post_uid).scalar() is None:
+            abort(HTTPStatus.NOT_FOUND)
+        # is the parent post part of the thread?
+        in_thread = (
+            db_session.query(Post.post_uid)
+            .filter(Post.post_uid == parent_uid, Post.root_uid == post_uid)
+            .scalar()
+        )
+        if in_thread is None:
+            abort(HTTPStatus.NOT_FOUND)
+        comments = _get_comments_page(db_session, parent_uid, request.args.get("cursor"))
+        tag_response(parent_uid, *(post.post_uid for post, child_count in comments.items))
+        return render_template(
+            "comments.html",
+            comments=comments,
+            root_post_uid=post_uid,
+            parent_uid=parent_uid,
+        )
 
 
 @login_required
@@ -162,7 +312,7 @@ def blog_post_update(post_uid=None):
             .filter(Post.post_uid == post_uid)
         )
         # can the current user view only active posts:
-        if current_user.is_anonymous or current_user.can_view_posts():
+        if current_permissions().views_active_posts_only:
             post = post.filter(Post.active == True)
         post = post.one_or_none()
         if post is None:
@@ -174,6 +324,8 @@ def blog_post_update(post_uid=None):
         if form.validate_on_submit():
             post.title = form.title.data.strip()
             post.content = form.content.data.strip()
+            post.update_excerpt()
+            post.update_content_html()
             if form.activate.data:
                 post.active = True
             elif form.deactivate.data:
@@ -199,14 +351,17 @@ def blog_post_create_comment():
             )
             db_session.add(post)
             db_session.flush()
-            root_post = post.parent
-            while root_post.parent is not None:
-                root_post = root_post.parent
+            root_post = (
+                db_session.query(Post)
+                .filter(Post.post_uid == post.root_uid)
+                .one()
+            )
+            root_post_uid = root_post.post_uid
             follow_root_post(db_session, root_post)
-            notify_root_post_followers(db_session, root_post)
             db_session.commit()
+            notify_root_post_followers(root_post_uid)
             flash("Comment created")
-            return redirect(url_for("content_bp.blog_post", post_uid=root_post.post_uid))
+            return redirect(url_for("content_bp.blog_post", post_uid=root_post_uid))
     else:
         flash("No comment to create")
     return redirect(request.referrer)
@@ -227,12 +382,8 @@ def utility_processor():
         Returns:
             Boolean: True if can update, False otherwise
         """
-        if not current_user.is_anonymous:
-            if current_user.role.permissions & (Role.Permissions.ADMINISTRATOR | Role.Permissions.EDITOR):
-                return True
-            if current_user.user_uid == post.user.user_uid:
-                return True
-        return False
+        permissions = current_permissions()
+        return permissions.is_editor or permissions.owns(post)
 
     def can_set_blog_post_active_state(post):
         """Determines if the current user is the same as the
@@ -245,17 +396,9 @@ def utility_processor():
         Returns:
             Boolean: True if can update, False otherwise
         """
-        # is the current user anonymous?
-        if current_user.is_anonymous:
-            return False
-        # is the current user an administrator or editor?
-        if current_user.role.permissions & (Role.Permissions.ADMINISTRATOR):
-            return True
-        # otherwise, is the current user the creator of the post?
-        else:
-            if current_user.user_uid == post.user.user_uid:
-                return True
-        return False
+        permissions = current_permissions()
+        # is the current user an administrator, or otherwise the creator of the post?
+        return permissions.is_administrator or permissions.owns(post)
 
     return dict(
         can_update_blog_post=can_update_blog_post,
@@ -263,83 +406,193 @@ def utility_processor():
     )
 
 
-def _build_posts_hierarchy(db_session, post_uid):
-    # build the list of filters here to use in the CTE
-    filters = [
-        Post.post_uid == post_uid,
-        Post.parent_uid == None
-    ]
-    if current_user.is_anonymous or current_user.can_view_posts():
-        filters.append(Post.active == True)
-
-    # build the recursive CTE query
-    hierarchy = (
+def _ensure_content_html(db_session, post):
+    """Makes sure the stored html of the post content matches the
+    content and markdown configuration, converting and storing
+    it if it doesn't. This doesn't change the post's updated time
+
+    Args:
+        db_session: The database session to use
+        post (Post): The post to get the html for
+    """
+    key = content_key(post.content)
+    if post.content_html is not None and post.content_html_key == key:
+        return
+    html, final = render_content(post.content)
+    if final:
+        db_session.execute(
+            update(Post)
+            .where(Post.post_uid == post.post_uid)
+            .values(content_html=html, content_html_key=key, updated=Post.updated)
+        )
+        db_session.commit()
+    set_committed_value(post, "content_html", html)
+
+
+def _ensure_excerpts(db_session, posts):
+    """Makes sure the stored listing excerpts of the posts were built with
+    the current markdown configuration, rebuilding and storing the ones
+    that weren't. This doesn't change the posts' updated time
+
+    Args:
+        db_session: The database session to use
+        posts (list): The posts to get the excerpts for
+    """
+    key = markdown_key()
+    stale = [post for post in posts if post.excerpt_key != key]
+    if not stale:
+        return
+    for post in stale:
+        excerpt, excerpt_html = build_excerpt(post.content)
+        db_session.execute(
+            update(Post)
+            .where(Post.post_uid == post.post_uid)
+            .values(excerpt=excerpt, excerpt_html=excerpt_html, excerpt_key=key, updated=Post.updated)
+        )
+        set_committed_value(post, "excerpt_html", excerpt_html)
+        set_committed_value(post, "excerpt_key", key)
+    db_session.commit()
+
+
+def _thread_load_options():
+    """Gets the loader options for what the thread templates read from
+    the posts, the authors of all the posts are loaded with one IN
+    query rather than joined to each post
+
+    Returns:
+        tuple: The loader options
+    """
+    return (
+        selectinload(Post.user),
+        lazyload(Post.parent),
+    )
+
+
+def _root_post_query(db_session, post_uid):
+    """Creates the query for a root post the current user can view
+
+    Args:
+        db_session: The database session to use
+        post_uid (str): The post_uid of the root post
+
+    Returns:
+        Query: The query for the root post
+    """
+    root_post = (
         db_session
-        .query(Post, Post.sort_key.label("sorting_key"))
-        .filter(*filters)
-        .cte(name='hierarchy', recursive=True)
+        .query(Post)
+        .options(*_thread_load_options())
+        .filter(Post.post_uid == post_uid, Post.parent_uid == None)
     )
-    children = aliased(Post, name="c")
-    hierarchy = hierarchy.union_all(
+    if current_permissions().views_active_posts_only:
+        root_post = root_post.filter(Post.active == True)
+    return root_post
+
+
+def _get_comments_page(db_session, parent_uid, cursor=None):
+    """Gets a page of the comments directly on a post, in thread order,
+    along with how many comments there are on each of them
+
+    Args:
+        db_session: The database session to use
+        parent_uid (str): The post_uid of the post the comments are on
+        cursor (str, optional): The path of the comment the page starts after
+
+    Returns:
+        KeysetPagination: The page of (Post, child_count) tuples
+    """
+    per_page = current_app.config.get("BLOG_POST_COMMENTS_PER_PAGE", 20)
+    comments = (
         db_session
-        .query(
-            children,
-            (
-                func.cast(hierarchy.c.sorting_key, String) +
-                " " +
-                func.cast(children.sort_key, String)
-            ).label("sorting_key")
-        )
-        .filter(children.parent_uid == hierarchy.c.post_uid)
+        .query(Post)
+        .options(*_thread_load_options())
+        .filter(Post.parent_uid == parent_uid)
     )
-    # query the hierarchy for the post and it's comments
-    return (
+    if cursor is not None:
+        comments = comments.filter(Post.path > cursor)
+    comments = comments.order_by(Post.path).limit(per_page + 1).all()
+    next_cursor = comments[per_page - 1].path if len(comments) > per_page else None
+    comments = comments[:per_page]
+    child_counts = dict(
         db_session
-        .query(Post, func.cast(hierarchy.c.sorting_key, String))
-        .select_entity_from(hierarchy)
-        .order_by(hierarchy.c.sorting_key)
+        .query(Post.parent_uid, func.count(Post.post_uid))
+        .filter(Post.parent_uid.in_([post.post_uid for post in comments]))
+        .group_by(Post.parent_uid)
         .all()
+    ) if comments else {}
+    return KeysetPagination(
+        [(post, child_counts.get(post.post_uid, 0)) for post in comments],
+        next_cursor=next_cursor
     )
 
 
+def _build_posts_hierarchy(db_session, post_uid):
+    """Gets a root post and all of its comments in thread order
+    with one range scan of the post path index
+
+    Args:
+        db_session: The database session to use
+        post_uid (str): The post_uid of the root post
+
+    Returns:
+        list: The (Post, path) tuples of the thread, or None if there's no root post
+    """
+    root_path = _root_post_query(db_session, post_uid).with_entities(Post.path).scalar()
+    if root_path is None:
+        return None
+    start, end = Post.thread_path_range(root_path)
+    posts = (
+        db_session
+        .query(Post)
+        .options(*_thread_load_options())
+        .filter(Post.path >= start, Post.path < end)
+        .order_by(Post.path)
+        .all()
+    )
+    return [(post, post.path) for post in posts]
+
+
 def follow_root_post(db_session, root_post):
     """Add the root post to the posts_followed collection
-    if user isn't already following the root_post
+    if user isn't already following the root_post, without
+    loading the posts the user already follows
 
     Args:
         db_session : The database session to use
         root_post : The root post to follow
     """
-    user = (
-        db_session.query(User)
-        .filter(User.user_uid == current_user.user_uid)
-        .one_or_none()
+    values = dict(user_uid=current_user.user_uid, post_uid=root_post.post_uid)
+    insert = dialect_insert(db_session)
+    if insert is not None:
+        # the conflict target fails loudly on a table without unique follows
+        db_session.execute(
+            insert(user_post)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=[user_post.c.user_uid, user_post.c.post_uid])
+        )
+        return
+    # the database can't ignore the conflict, so check for the follow first
+    following = (
+        db_session
+        .query(user_post.c.user_uid)
+        .filter_by(**values)
+        .first()
     )
-    if user is not None and root_post not in user.posts_followed:
-        user.posts_followed.append(root_post)
+    if following is None:
+        db_session.execute(user_post.insert().values(**values))
 
 
-def notify_root_post_followers(db_session, root_post):
-    """Notify users who are following the root post
-    about an update via email
+def notify_root_post_followers(root_post_uid):
+    """Notify users who are following the root post about an
+    update via email, the emails are sent in batches of followers
+    outside the request
 
     Args:
-        db_session : The database session to use
-        root_post : The root post that had an update
+        root_post_uid (str): The post_uid of the root post that had an update
     """
     post_url = url_for(
         "content_bp.blog_post",
-        post_uid=root_post.post_uid,
+        post_uid=root_post_uid,
         _external=True
     )
-    for user_following in root_post.users_following:
-        to = user_following.email
-        subject = "A post you're following has been updated"
-        contents = (
-            f"""Hi {user_following.first_name},
-            A blog post you're following has had a comment added to it. You can view
-            that post here: {post_url}
-            Thank you!
-            """
-        )
-        send_mail(to=to, subject=subject, contents=contents)
+    notify_followers(root_post_uid, post_url)
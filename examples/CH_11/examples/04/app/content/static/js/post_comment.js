@@ -3,17 +3,38 @@
  * to put the put the post_uid value into the
  * create comment form's parent_post_uid field
  */
-const buttons = document.getElementsByClassName('post-comment')
-for (const button of buttons) {
-  button.addEventListener('click', (e) => {
-    const post_uid = e.target.dataset.postUid;
-    document.getElementById('parent_post_uid').value = post_uid;
-  })
-}
+document.addEventListener('click', (e) => {
+  const button = e.target.closest('.post-comment');
+  if (button !== null) {
+    document.getElementById('parent_post_uid').value = button.dataset.postUid;
+  }
+})
+/**
+ * Handle the load comments buttons by replacing
+ * the button with the page of comments it fetches
+ */
+document.addEventListener('click', async (e) => {
+  const button = e.target.closest('.load-comments');
+  if (button === null) {
+    return;
+  }
+  button.disabled = true;
+  const response = await fetch(button.dataset.url);
+  if (response.ok) {
+    const template = document.createElement('template');
+    template.innerHTML = await response.text();
+    window.formatLocalTimes(template.content);
+    button.parentElement.replaceWith(template.content);
+  } else {
+    button.disabled = false;
+  }
+})
 /**
  * Set the focus on text area in the modal
  */
 const commentModal = document.getElementById('comment_modal');
-commentModal.addEventListener('shown.bs.modal', () => {
-  document.getElementById("comment").focus();
-})
+if (commentModal !== null) {
+  commentModal.addEventListener('shown.bs.modal', () => {
+    document.getElementById("comment").focus();
+  })
+}
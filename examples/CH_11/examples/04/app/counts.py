@@ -0,0 +1,181 @@
+from logging import getLogger
+
+from flask_sqlalchemy import Pagination
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+
+from .models import Post, PostCount, db_session_manager
+
+logger = getLogger(__name__)
+
+# the names of the post totals kept in the post_count table
+ACTIVE_ROOT_POSTS = "active_root_posts"
+ALL_ROOT_POSTS = "all_root_posts"
+
+# how many pages past the current page an approximate count looks ahead
+APPROXIMATE_LOOKAHEAD_PAGES = 5
+
+
+def init_post_counts():
+    """Seeds any post totals missing from the post_count table by
+    counting the posts once, after that the totals are maintained
+    incrementally as posts are created and (de)activated
+    """
+    counts = {
+        ACTIVE_ROOT_POSTS: lambda q: q.filter(Post.parent_uid == None, Post.active == True),
+        ALL_ROOT_POSTS: lambda q: q.filter(Post.parent_uid == None),
+    }
+    with db_session_manager() as db_session:
+        existing = {name for (name,) in db_session.query(PostCount.name)}
+        for name, filters in counts.items():
+            if name in existing:
+                continue
+            value = filters(db_session.query(Post)).count()
+            db_session.add(PostCount(name=name, value=value))
+            logger.info(f"post count {name} seeded with {value}")
+        try:
+            db_session.commit()
+        # another worker seeded the counts first
+        except IntegrityError:
+            db_session.rollback()
+
+
+def _increment(connection, name, delta):
+    connection.execute(
+        update(PostCount)
+        .where(PostCount.name == name)
+        .values(value=PostCount.value + delta)
+    )
+
+
+@event.listens_for(Post, "after_insert")
+def _count_inserted_post(mapper, connection, target):
+    """Counts a new root post in the same transaction that inserts it
+    """
+    if target.parent_uid is not None:
+        return
+    _increment(connection, ALL_ROOT_POSTS, 1)
+    if target.active:
+        _increment(connection, ACTIVE_ROOT_POSTS, 1)
+
+
+@event.listens_for(Post, "after_update")
+def _count_updated_post(mapper, connection, target):
+    """Moves a root post in or out of the active total in the same
+    transaction that changes its active state
+    """
+    if target.parent_uid is not None:
+        return
+    if not _is_active_changed(target):
+        return
+    _increment(connection, ACTIVE_ROOT_POSTS, 1 if target.active else -1)
+
+
+def _is_active_changed(target):
+    history = inspect(target).attrs.active.history
+    return history.has_changes() and bool(history.deleted and history.deleted[0]) != bool(target.active)
+
+
+def thread_stats_values(root_uid):
+    """Creates the update values that recompute the thread statistics
+    of root posts from their comments, keeping their updated time
+
+    Args:
+        root_uid: The post_uid of the root post, or Post.post_uid
+            to recompute every root post the update matches
+
+    Returns:
+        dict: The values for an update of the root posts
+    """
+    comment = Post.__table__.alias("comment")
+    thread_comments = (
+        comment.c.root_uid == root_uid,
+        comment.c.post_uid != root_uid,
+        comment.c.active == True,
+    )
+    return {
+        "comment_count": select(func.count()).select_from(comment).where(*thread_comments).scalar_subquery(),
+        "last_comment_at": select(func.max(comment.c.created)).where(*thread_comments).scalar_subquery(),
+        "updated": Post.updated,
+    }
+
+
+@event.listens_for(Post, "after_insert")
+def _count_inserted_comment(mapper, connection, target):
+    """Counts a new comment in its thread's statistics in the
+    same transaction that inserts it
+    """
+    if target.parent_uid is None or not target.active:
+        return
+    connection.execute(
+        update(Post)
+        .where(Post.post_uid == target.root_uid)
+        .values(
+            comment_count=Post.comment_count + 1,
+            last_comment_at=target.created,
+            # the thread statistics don't change when the root post was updated
+            updated=Post.updated
+        )
+    )
+
+
+@event.listens_for(Post, "after_update")
+def _count_updated_comment(mapper, connection, target):
+    """Recomputes the statistics of a comment's thread in the
+    same transaction that changes the comment's active state
+    """
+    if target.parent_uid is None or not _is_active_changed(target):
+        return
+    connection.execute(
+        update(Post)
+        .where(Post.post_uid == target.root_uid)
+        .values(**thread_stats_values(target.root_uid))
+    )
+
+
+def get_post_count(db_session, name):
+    """Gets a post total from the post_count table
+
+    Args:
+        db_session: The database session to use
+        name (str): The name of the post total
+
+    Returns:
+        int: The post total, or None if it hasn't been seeded
+    """
+    return (
+        db_session
+        .query(PostCount.value)
+        .filter(PostCount.name == name)
+        .scalar()
+    )
+
+
+def paginate_counted(query, page, per_page, total=None):
+    """Paginates the query using a known total instead of counting the
+    query. Without a total the query is counted up to a few pages past
+    the current page, and the pagination is flagged as approximate if
+    there are more items than that
+
+    Args:
+        query (Query): The ordered query to paginate
+        page (int): The page number to get, None for the first page
+        per_page (int): The number of items per page
+        total (int, optional): The total number of items the query returns
+
+    Returns:
+        Pagination: The page of items
+    """
+    page = page if page is not None and page > 0 else 1
+    offset = (page - 1) * per_page
+    items = query.limit(per_page).offset(offset).all()
+    approximate = False
+    if total is None:
+        limit = offset + per_page * (APPROXIMATE_LOOKAHEAD_PAGES + 1) + 1
+        total = query.order_by(None).limit(limit).count()
+        if total == limit:
+            total -= 1
+            approximate = True
+    pagination = Pagination(query, page, per_page, total, items)
+    pagination.approximate = approximate
+    return pagination
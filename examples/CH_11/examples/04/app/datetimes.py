@@ -0,0 +1,94 @@
+from datetime import timezone
+from functools import lru_cache
+from logging import getLogger
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from flask import current_app, g, has_request_context, session
+from markupsafe import Markup, escape
+
+logger = getLogger(__name__)
+
+# the timezone dates are shown in when the user's browser didn't say
+DEFAULT_TIMEZONE = "America/New_York"
+
+# the default format of the dates shown on the pages
+DEFAULT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@lru_cache(maxsize=128)
+def get_timezone(name):
+    """Gets the timezone with the IANA name, the timezones are kept
+    so each one is only loaded from the timezone database once
+
+    Args:
+        name (str): The IANA name of the timezone, ex: "America/New_York"
+
+    Returns:
+        tzinfo: The timezone, or the default timezone if the name is unknown,
+            or UTC if the default timezone isn't in the timezone database either
+    """
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        if name == DEFAULT_TIMEZONE:
+            # hosts without a timezone database need the tzdata package
+            logger.error(f"default timezone {DEFAULT_TIMEZONE!r} not found, using UTC")
+            return timezone.utc
+        logger.warning(f"unknown timezone {name!r}, using {DEFAULT_TIMEZONE}")
+        return get_timezone(DEFAULT_TIMEZONE)
+
+
+def request_timezone():
+    """Gets the timezone of the current user's browser, resolved
+    once per request from the session
+
+    Returns:
+        tzinfo: The timezone to show dates in
+    """
+    if not has_request_context():
+        return get_timezone(DEFAULT_TIMEZONE)
+    if "timezone" not in g:
+        g.timezone = get_timezone(session.get("timezone_info", {}).get("timeZone", DEFAULT_TIMEZONE))
+    return g.timezone
+
+
+def _client_time(value, format):
+    # the browser formats the time in its own timezone, the
+    # text is the UTC time for clients without javascript
+    return Markup(
+        f'<time class="local-time" datetime="{value.isoformat()}" data-format="{escape(format)}">'
+        f'{escape(value.strftime(format))} UTC</time>'
+    )
+
+
+def format_datetimes(values, format=DEFAULT_FORMAT):
+    """Formats the UTC datetimes in the current user's timezone, looking
+    up the timezone once for all of them. With the datetime_client_format
+    setting on, the server skips the conversion and emits ISO-8601 times
+    for the browser to format instead
+
+    Args:
+        values (iterable): The naive or UTC datetimes, None values are kept as None
+        format (str): The strftime format of the dates
+
+    Returns:
+        list: The formatted dates
+    """
+    values = [None if value is None else value.replace(tzinfo=timezone.utc) for value in values]
+    if current_app.config.get("DATETIME_CLIENT_FORMAT", False):
+        return [None if value is None else _client_time(value, format) for value in values]
+    tz = request_timezone()
+    return [None if value is None else value.astimezone(tz).strftime(format) for value in values]
+
+
+def format_datetime(value, format=DEFAULT_FORMAT):
+    """Formats a UTC datetime in the current user's timezone
+
+    Args:
+        value (datetime): The naive or UTC datetime
+        format (str): The strftime format of the date
+
+    Returns:
+        str: The formatted date
+    """
+    return format_datetimes([value], format)[0]
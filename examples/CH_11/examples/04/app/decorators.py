@@ -1,6 +1,6 @@
 from functools import wraps
 from flask import abort
-from flask_login import current_user
+from .permissions import current_permissions
 
 
 def authorization_required(permissions):
@@ -12,7 +12,7 @@ def authorization_required(permissions):
     def wrapper(func):
         @wraps(func)
         def wrapped_function(*args, **kwargs):
-            if not current_user.role.permissions & permissions:
+            if not current_permissions().has_any(permissions):
                 abort(403)
             return func(*args, **kwargs)
         return wrapped_function
@@ -1,12 +1,23 @@
 from logging import getLogger
 
-import sib_api_v3_sdk
 from flask import current_app
-from sib_api_v3_sdk.rest import ApiException
 
 logger = getLogger(__name__)
-configuration = sib_api_v3_sdk.Configuration()
-configuration.api_key['api-key'] = current_app.config.get("SIB_API_KEY")
+
+# the SendInBlue client configuration, created when the first email is sent
+# because importing the SendInBlue SDK noticeably slows down starting up
+_configuration = None
+
+
+def _transactional_emails_api():
+    global _configuration
+    import sib_api_v3_sdk
+
+    if _configuration is None:
+        configuration = sib_api_v3_sdk.Configuration()
+        configuration.api_key['api-key'] = current_app.config.get("SIB_API_KEY")
+        _configuration = configuration
+    return sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(_configuration))
 
 
 def send_mail(to, subject, contents):
@@ -18,7 +29,10 @@ def send_mail(to, subject, contents):
         contents (string): The html formatted email contents
     """
 
-    api_instance = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
+    import sib_api_v3_sdk
+    from sib_api_v3_sdk.rest import ApiException
+
+    api_instance = _transactional_emails_api()
     smtp_email = sib_api_v3_sdk.SendSmtpEmail(
         to=[{"email": to}],
         html_content=contents,
@@ -30,3 +44,39 @@ def send_mail(to, subject, contents):
         logger.debug(f"Confirmation email sent to {to}")
     except ApiException as e:
         logger.exception("Exception sending email", exc_info=e)
+
+
+def send_batch_mail(recipients, subject, contents):
+    """Sends the same email to many recipients with one SendInBlue
+    request, each recipient gets their own message version
+
+    Args:
+        recipients (list): Dictionaries with the "email" address of each
+            recipient and the "params" to use in their version of the email
+        subject (string): The subject of the email
+        contents (string): The html formatted email contents, which can
+            use the recipient's params, ex: {{ params.first_name }}
+    """
+    if not recipients:
+        return
+    import sib_api_v3_sdk
+    from sib_api_v3_sdk.rest import ApiException
+
+    api_instance = _transactional_emails_api()
+    smtp_email = sib_api_v3_sdk.SendSmtpEmail(
+        html_content=contents,
+        sender={"name": "MyBlog", "email": "no-reply@myblog.com"},
+        subject=subject,
+        message_versions=[
+            sib_api_v3_sdk.SendSmtpEmailMessageVersions(
+                to=[{"email": recipient["email"]}],
+                params=recipient.get("params")
+            )
+            for recipient in recipients
+        ]
+    )
+    try:
+        api_instance.send_transac_email(smtp_email)
+        logger.debug(f"Batch email sent to {len(recipients)} recipients")
+    except ApiException as e:
+        logger.exception("Exception sending batch email", exc_info=e)
@@ -0,0 +1,77 @@
+from flask import session
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import event
+
+from .cache import TaggedCache
+from .models import Post
+from .permissions import viewer_permission_class
+
+# the cache holding the rendered template fragments
+fragment_cache = TaggedCache()
+
+
+class FragmentCacheExtension(Extension):
+    """Adds a {% cache tag, key, ... %}...{% endcache %} tag to the templates
+    that renders the enclosed fragment once and reuses it while the
+    tag and key values stay the same. The first value is the tag used
+    to invalidate the fragment, which is the post_uid for post content
+    """
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        call = self.call_method(
+            "_render_fragment",
+            [nodes.Const(parser.name), nodes.Const(lineno), nodes.List(key_parts)]
+        )
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, template_name, lineno, key_parts, caller):
+        key = (template_name, lineno, *key_parts)
+        fragment = fragment_cache.get(key)
+        if fragment is None:
+            fragment = str(caller())
+            fragment_cache.set(key, fragment, tags=(key_parts[0],))
+        return Markup(fragment)
+
+
+def init_fragment_cache(app):
+    """Adds the fragment cache tag to the application templates
+
+    Args:
+        app (Flask): The Flask app instance
+    """
+    fragment_cache.configure(
+        maxsize=app.config.get("FRAGMENT_CACHE_MAXSIZE", 4096),
+        ttl=app.config.get("FRAGMENT_CACHE_TTL", 300)
+    )
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    @app.context_processor
+    def inject_viewer_cache_key():
+        def viewer_cache_key():
+            """Gets the parts of the fragment cache key that depend
+            on the viewer rather than the content
+
+            Returns:
+                tuple: The viewer's permission class and timezone
+            """
+            return (
+                viewer_permission_class(),
+                session.get("timezone_info", {}).get("timeZone"),
+            )
+        return dict(viewer_cache_key=viewer_cache_key)
+
+
+@event.listens_for(Post, "after_insert")
+@event.listens_for(Post, "after_update")
+def _invalidate_post_fragments(mapper, connection, target):
+    """Drops the cached fragments of a post when it changes
+    """
+    fragment_cache.invalidate(target.post_uid)
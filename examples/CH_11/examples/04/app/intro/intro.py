@@ -4,6 +4,9 @@ from . import intro_bp
 from flask_login import login_required
 from ..decorators import authorization_required
 from ..models import Role
+from ..response_cache import response_cache
+from ..fragment_cache import fragment_cache
+from ..passwords import password_pool
 
 logger = getLogger(__file__)
 
@@ -30,4 +33,12 @@ def auth_required():
 @login_required
 @authorization_required(Role.Permissions.ADMINISTRATOR)
 def admin_required():
-    return render_template("admin_required.html")
+    cache_stats = {
+        "Response cache": response_cache.stats(),
+        "Fragment cache": fragment_cache.stats(),
+    }
+    return render_template(
+        "admin_required.html",
+        cache_stats=cache_stats,
+        password_pool_stats=password_pool.stats()
+    )
@@ -1,12 +1,14 @@
+import os
 from contextlib import contextmanager
 from enum import Flag, auto
 from flask import current_app
-from flask_bcrypt import (
-    generate_password_hash,
-    check_password_hash
-)
-from sqlalchemy import func
+from sqlalchemy import func, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm.attributes import set_committed_value
 from . import db
+from .passwords import password_pool
+from .rendering import build_excerpt, content_key, markdown_key, render_content
 from flask_login import UserMixin
 from uuid import uuid4
 from datetime import datetime, timezone
@@ -15,9 +17,16 @@ from itsdangerous import (
     SignatureExpired,
     BadSignature
 )
+from threading import Lock
+from weakref import WeakKeyDictionary
 from time import time
+from types import MappingProxyType
+from typing import NamedTuple
+from logging import getLogger
 import jwt
 
+logger = getLogger(__name__)
+
 
 @contextmanager
 def db_session_manager(session_close=True):
@@ -38,6 +47,29 @@ def db_session_manager(session_close=True):
             db.session.close()
 
 
+def dialect_insert(db_session):
+    """Gets the insert construct of the database the session uses,
+    which supports the INSERT ... ON CONFLICT clauses. The callers
+    fall back to checking for the existing rows first on the other
+    databases
+
+    Args:
+        db_session (Session): The database session to use
+
+    Returns:
+        function: The dialect's insert function, or None if the
+            database doesn't support ON CONFLICT
+    """
+    dialect_name = db_session.connection().dialect.name
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    return insert
+
+
 def get_uuid():
     """Generate a shortened UUID4 value to use
     as the primary key for database records
@@ -52,8 +84,10 @@ def get_uuid():
 # the user and post tables
 user_post = db.Table(
     "user_post",
-    db.Column("user_uid", db.String, db.ForeignKey("user.user_uid")),
-    db.Column("post_uid", db.String, db.ForeignKey("post.post_uid"))
+    db.Column("user_uid", db.String, db.ForeignKey("user.user_uid"), primary_key=True),
+    db.Column("post_uid", db.String, db.ForeignKey("post.post_uid"), primary_key=True),
+    # supports finding the followers of a post
+    db.Index("ix_user_post_post_uid_user_uid", "post_uid", "user_uid"),
 )
 
 
@@ -71,8 +105,16 @@ class User(UserMixin, db.Model):
     last_name = db.Column(db.String, nullable=False)
     email = db.Column(db.String, nullable=False, unique=True, index=True)
     hashed_password = db.Column("password", db.String, nullable=False)
+    # changes when the password, role or active state changes, which
+    # invalidates the principal snapshots of the user's sessions
+    security_stamp = db.Column(db.String, default=get_uuid)
     posts = db.relationship("Post", backref=db.backref("user", lazy="joined"))
-    posts_followed = db.relationship("Post", secondary=user_post, backref=db.backref("users_following", lazy="dynamic"))
+    posts_followed = db.relationship(
+        "Post",
+        secondary=user_post,
+        lazy="dynamic",
+        backref=db.backref("users_following", lazy="dynamic")
+    )
     active = db.Column(db.Boolean, nullable=False, default=True)
     confirmed = db.Column(db.Boolean, default=False)
     created = db.Column(db.DateTime, nullable=False, default=datetime.now(tz=timezone.utc))
@@ -92,14 +134,39 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.hashed_password = generate_password_hash(password)
+        self.hashed_password = password_pool.hash_password(password)
 
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
 
     def verify_password(self, password):
-        return check_password_hash(self.hashed_password, password)
+        return password_pool.check_password(self.hashed_password, password)
+
+    def rehash_password(self, db_session, password):
+        """Hashes the user's verified password again if its hash was created
+        with a different bcrypt cost than the configured one. The password
+        doesn't change, so neither do the user's updated time and security
+        stamp, keeping the user's other sessions valid
+
+        Args:
+            db_session (Session): The database session to use
+            password (str): The user's verified password
+
+        Returns:
+            bool: True if the password was hashed again
+        """
+        if not password_pool.needs_rehash(self.hashed_password):
+            return False
+        hashed_password = password_pool.hash_password(password)
+        db_session.execute(
+            update(User)
+            .where(User.user_uid == self.user_uid)
+            .values(hashed_password=hashed_password, updated=User.updated)
+            .execution_options(synchronize_session=False)
+        )
+        set_committed_value(self, "hashed_password", hashed_password)
+        return True
 
     def confirmation_token(self):
         serializer = URLSafeTimedSerializer(current_app.config["SECRET_KEY"])
@@ -140,8 +207,18 @@ class User(UserMixin, db.Model):
         )["reset_password"]
         return user_uid
 
+    @property
+    def role_info(self):
+        """Gets the user's role from the role registry
+        instead of loading it from the database
+
+        Returns:
+            RoleInfo: The user's role
+        """
+        return role_registry.by_uid(self.role_uid)
+
     def can_view_posts(self):
-        can_view = (self.role.permissions | Role.Permissions.REGISTERED).value
+        can_view = (self.role_info.permissions | Role.Permissions.REGISTERED).value
         return 0 <= can_view <= 1
 
     def __repr__(self):
@@ -151,15 +228,25 @@ class User(UserMixin, db.Model):
         email: {self.email}
         confirmed: {self.confirmed}
         active: {'True' if self.active else 'False'}
-            role_uid: {self.role.role_uid}
-            name: {self.role.name}
-            description: {self.role.description}
-            permissions: {self.role.permissions}
+            role_uid: {self.role_info.role_uid}
+            name: {self.role_info.name}
+            description: {self.role_info.description}
+            permissions: {self.role_info.permissions}
         created: {self.created}
         updated: {self.updated}
         """
 
 
+@db.event.listens_for(User, "before_update")
+def _rotate_security_stamp(mapper, connection, target):
+    """Gives the user a new security stamp when their password,
+    role or active state changes
+    """
+    state = db.inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in ("hashed_password", "role_uid", "active")):
+        target.security_stamp = get_uuid()
+
+
 class Role(db.Model):
     """The Role class which is essentially a lookup table
     used to contain the roles supported by the MyBlog
@@ -183,7 +270,8 @@ class Role(db.Model):
     name = db.Column(db.String, nullable=False, unique=True)
     description = db.Column(db.String, nullable=False)
     raw_permissions = db.Column(db.Integer)
-    users = db.relationship("User", backref=db.backref("role", lazy="joined"))
+    # the user's role comes from the role registry, so loading a user doesn't join it
+    users = db.relationship("User", backref=db.backref("role", lazy="select"))
     active = db.Column(db.Boolean, nullable=False, default=True)
     created = db.Column(db.DateTime, nullable=False, default=datetime.now(tz=timezone.utc))
     updated = db.Column(
@@ -242,7 +330,15 @@ class Role(db.Model):
                     role.raw_permissions = r.get("raw_permissions")
 
                 db_session.add(role)
+
+            # the running workers reload their role registries when this changes
+            roles_version = db_session.query(SchemaVersion).get(ROLES_VERSION_NAME)
+            if roles_version is None:
+                roles_version = SchemaVersion(name=ROLES_VERSION_NAME, version=0)
+                db_session.add(roles_version)
+            roles_version.version += 1
             db_session.commit()
+            role_registry.load(db_session)
 
     def __repr__(self):
         return f"""
@@ -255,43 +351,462 @@ class Role(db.Model):
         """
 
 
-def get_next_sort_key() -> int:
-    """Generates an incrementing sort_key value from the database
+class RoleInfo(NamedTuple):
+    """An immutable copy of a row of the role lookup table
+    """
+    role_uid: str
+    name: str
+    description: str
+    raw_permissions: int
+
+    @property
+    def permissions(self):
+        return Role.Permissions(self.raw_permissions)
+
+
+# the name of the schema_version row counting the changes to the role table
+ROLES_VERSION_NAME = "roles"
+
+
+class RoleRegistry:
+    """Holds the role lookup table in memory, so the roles can be found
+    by name or role_uid without querying or joining the role table. The
+    roles are seeded by Role.initialize_role_table, which bumps the roles
+    version row, and the registry reloads the roles when it sees that
+    version change, checking it at most once every check interval
+    """
+    def __init__(self, check_interval=30.0):
+        self._lock = Lock()
+        self.version = None
+        self.check_interval = check_interval
+        self._checked_at = 0.0
+        self._by_uid = MappingProxyType({})
+        self._by_name = MappingProxyType({})
+
+    def configure(self, check_interval):
+        """Sets how often the registry checks the roles version
+
+        Args:
+            check_interval (float): The seconds between checks of the roles version
+        """
+        self.check_interval = check_interval
+
+    def load(self, db_session):
+        """Replaces the registered roles with the roles in the role table
+
+        Args:
+            db_session (Session): The database session to use
+        """
+        version = self._stored_version(db_session)
+        roles = [
+            RoleInfo(role.role_uid, role.name, role.description, role.raw_permissions or 0)
+            for role in db_session.query(Role)
+        ]
+        self._by_uid = MappingProxyType({role.role_uid: role for role in roles})
+        self._by_name = MappingProxyType({role.name: role for role in roles})
+        self.version = version
+        self._checked_at = time()
+
+    def refresh(self, db_session):
+        """Reloads the registered roles if the roles version changed since
+        they were loaded, checking the version at most once every check
+        interval so most calls don't query the database
 
-    Raises:
-        RuntimeError: If the query fails, raises an exception
+        Args:
+            db_session (Session): The database session to use
+
+        Returns:
+            bool: True if the roles were reloaded
+        """
+        with self._lock:
+            if time() - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = time()
+        if self._stored_version(db_session) == self.version:
+            return False
+        self.load(db_session)
+        logger.info(f"role registry reloaded at roles version {self.version}")
+        return True
+
+    @staticmethod
+    def _stored_version(db_session):
+        return (
+            db_session
+            .query(SchemaVersion.version)
+            .filter(SchemaVersion.name == ROLES_VERSION_NAME)
+            .scalar()
+        )
+
+    @property
+    def roles(self):
+        """Gets the registered roles by name
+
+        Returns:
+            Mapping: The read-only mapping of role names to RoleInfo
+        """
+        return self._by_name
+
+    def by_uid(self, role_uid):
+        """Gets a registered role by its role_uid
+
+        Args:
+            role_uid (str): The role_uid of the role
+
+        Raises:
+            KeyError: If there is no role with the role_uid
+
+        Returns:
+            RoleInfo: The role
+        """
+        return self._by_uid[role_uid]
+
+    def by_name(self, name):
+        """Gets a registered role by its name
+
+        Args:
+            name (str): The name of the role
+
+        Raises:
+            KeyError: If there is no role with the name
+
+        Returns:
+            RoleInfo: The role
+        """
+        return self._by_name[name]
+
+
+# the process wide registry of the roles in the role table
+role_registry = RoleRegistry()
+
+
+class SortKeyAllocator:
+    """Hands out post sort_keys from blocks of keys reserved in the
+    database, so getting a key is usually an in-memory increment and
+    concurrent writers never get the same key. Each worker process
+    reserves its own blocks, so keys only increase within a worker's
+    thread. A block reserved in a session's transaction is only used
+    by that session until it commits, as a rollback gives its keys back.
+    On PostgreSQL the blocks are as large as the native sequence's
+    increment, which is only set when init-db creates the sequence
+    """
+    # the name of the sequence the blocks are reserved from
+    SEQUENCE_NAME = "post_sort_key"
+
+    def __init__(self, block_size=1):
+        self.block_size = block_size
+        self._lock = Lock()
+        # the committed block shared by the sessions, as [next key, end key]
+        self._block = [0, 0]
+        # the blocks reserved in uncommitted transactions, by session
+        self._pending_blocks = WeakKeyDictionary()
+        self._pid = os.getpid()
+        self._sequence_increment = None
+
+    def configure(self, block_size):
+        """Sets the number of keys reserved at a time and drops
+        the rest of the current block
+
+        Args:
+            block_size (int): The number of keys reserved at a time
+        """
+        with self._lock:
+            self.block_size = max(1, block_size)
+            self._block = [0, 0]
+            self._pending_blocks.clear()
+            self._sequence_increment = None
+
+    def allocate(self, count=1, db_session=None):
+        """Gets unused sort_key values, reserving more blocks
+        from the database when the current one runs out
+
+        Args:
+            count (int): The number of keys to get
+            db_session (Session, optional): The session inserting the posts,
+                blocks are reserved in its transaction, so a session that
+                already wrote doesn't wait on its own write lock. Without
+                one, blocks are reserved in a transaction of their own
+
+        Returns:
+            list: The increasing sort_key values
+        """
+        db_session = self._actual_session(db_session)
+        keys = []
+        while True:
+            with self._lock:
+                # a forked worker mustn't use the keys left in its parent's block
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._block = [0, 0]
+                    self._pending_blocks.clear()
+                # the session's own block goes first, it's the newest one it saw
+                pending = self._pending_blocks.get(db_session) if db_session is not None else None
+                keys.extend(self._take(pending or self._block, count - len(keys)))
+                if len(keys) == count:
+                    return keys
+            # reserved without holding the lock, the reservation may wait on
+            # another session's write lock and that session may need keys
+            block, committed = self._reserve_block(db_session)
+            with self._lock:
+                if not committed:
+                    self._pending_blocks[db_session] = block
+                elif block[1] > self._block[1]:
+                    self._block = block
+
+    def transaction_committed(self, db_session):
+        """Shares the rest of the block reserved in the session's committed
+        transaction, when it's newer than the shared block
+
+        Args:
+            db_session (Session): The session whose transaction committed
+        """
+        db_session = self._actual_session(db_session)
+        with self._lock:
+            block = self._pending_blocks.pop(db_session, None)
+            if block is not None and block[1] > self._block[1]:
+                self._block = block
+
+    def transaction_ended(self, db_session):
+        """Drops the block reserved in the session's transaction if it
+        wasn't committed, the rolled back reservation gives its keys
+        back to the database, so they mustn't be used
+
+        Args:
+            db_session (Session): The session whose transaction ended
+        """
+        db_session = self._actual_session(db_session)
+        with self._lock:
+            self._pending_blocks.pop(db_session, None)
+
+    @staticmethod
+    def _actual_session(db_session):
+        # the scoped session is shared by the threads, the blocks belong to each thread's session
+        if isinstance(db_session, scoped_session):
+            return db_session.registry()
+        return db_session
+
+    @staticmethod
+    def _take(block, count):
+        keys = list(range(block[0], min(block[0] + count, block[1])))
+        block[0] += len(keys)
+        return keys
+
+    def _reserve_block(self, db_session):
+        # returns the reserved block and whether it's already committed
+        if db.engine.dialect.name == "postgresql":
+            # nextval isn't rolled back, so the session's connection can always be used
+            if db_session is not None:
+                return self._reserve_sequence_block(db_session.connection()), True
+            with db.engine.connect() as connection:
+                return self._reserve_sequence_block(connection), True
+        if db_session is not None:
+            return self._reserve_table_block(db_session.connection()), False
+        with db.engine.begin() as connection:
+            return self._reserve_table_block(connection), True
+
+    def _reserve_sequence_block(self, connection):
+        name = SortKeySequence.postgresql_sequence_name()
+        # the block size is the sequence's own increment, so workers
+        # configured with different block sizes can't overlap
+        if self._sequence_increment is None:
+            self._sequence_increment = connection.execute(
+                text("SELECT increment_by FROM pg_sequences WHERE sequencename = :name"),
+                {"name": name}
+            ).scalar()
+        start = connection.execute(text(f"SELECT nextval('{name}')")).scalar()
+        return [start, start + self._sequence_increment]
+
+    def _reserve_table_block(self, connection):
+        sequence = SortKeySequence.__table__
+        connection.execute(
+            update(sequence)
+            .where(sequence.c.name == self.SEQUENCE_NAME)
+            .values(next_value=sequence.c.next_value + self.block_size)
+        )
+        end = connection.execute(
+            select(sequence.c.next_value).where(sequence.c.name == self.SEQUENCE_NAME)
+        ).scalar()
+        if end is None:
+            raise RuntimeError("Failed to reserve sort_key values, the sequence isn't initialized")
+        return [end - self.block_size, end]
+
+
+# the process wide sort_key allocator used by the post inserts
+sort_key_allocator = SortKeyAllocator()
+
+
+def get_next_sort_key() -> int:
+    """Generates an incrementing sort_key value from the
+    block of keys reserved by this worker
 
     Returns:
-        integer: The new max value sort_key to use
+        integer: The new sort_key to use
+    """
+    return sort_key_allocator.allocate()[0]
+
+
+class SortKeySequence(db.Model):
+    """The sort key sequence class holds the next sort_key not yet reserved
+    by a worker, on databases without native sequences
     """
-    with db_session_manager(session_close=False) as db_session:
-        retval = db_session.query(func.ifnull(func.max(Post.sort_key) + 1, 0)).scalar()
-        if retval is None:
-            raise RuntimeError("Failed to get new value for sort_key")
-        return retval
+    __tablename__ = "sort_key_sequence"
+    name = db.Column(db.String, primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def postgresql_sequence_name():
+        """Gets the name of the native sequence used on PostgreSQL
+
+        Returns:
+            str: The sequence name
+        """
+        return f"{SortKeyAllocator.SEQUENCE_NAME}_seq"
+
+    @staticmethod
+    def initialize_sequence(block_size):
+        """Creates the sort_key sequence if necessary, starting after the
+        largest existing sort_key, and sets the number of keys each
+        worker reserves at a time
+
+        Args:
+            block_size (int): The number of keys reserved at a time
+        """
+        block_size = max(1, block_size)
+        sort_key_allocator.configure(block_size)
+        with db_session_manager() as db_session:
+            start = db_session.query(func.coalesce(func.max(Post.sort_key) + 1, 0)).scalar()
+            if db.engine.dialect.name == "postgresql":
+                name = SortKeySequence.postgresql_sequence_name()
+                # the sequence hands out the start of each block, its increment
+                # is the block size and is only set when it's created, so the
+                # running workers never see it change
+                db_session.execute(text(
+                    f"CREATE SEQUENCE IF NOT EXISTS {name} MINVALUE 0 START WITH {start} INCREMENT BY {block_size}"
+                ))
+                db_session.commit()
+                increment = db_session.execute(
+                    text("SELECT increment_by FROM pg_sequences WHERE sequencename = :name"),
+                    {"name": name}
+                ).scalar()
+                if increment != block_size:
+                    logger.warning(
+                        f"sort_key blocks are {increment} keys, the {name} sequence's increment, "
+                        f"not sort_key_block_size {block_size}, change it with ALTER SEQUENCE "
+                        "while no workers are running"
+                    )
+                return
+            if db_session.query(SortKeySequence).get(SortKeyAllocator.SEQUENCE_NAME) is not None:
+                return
+            db_session.add(SortKeySequence(name=SortKeyAllocator.SEQUENCE_NAME, next_value=start))
+            try:
+                db_session.commit()
+            # another worker initialized it first
+            except IntegrityError:
+                db_session.rollback()
 
 
 class Post(db.Model):
     """The post class holds the main blog posts content and comments for the
     MyBlog application
     """
+    # the width each sort_key is zero padded to in a path
+    PATH_SEGMENT_WIDTH = 10
+
     __tablename__ = "post"
+    __table_args__ = (
+        # support the keyset paginated listing of root posts in (updated, post_uid)
+        # order, for the viewers of only active posts and of all posts
+        db.Index("ix_post_parent_uid_active_updated_post_uid", "parent_uid", "active", "updated", "post_uid"),
+        db.Index("ix_post_parent_uid_updated_post_uid", "parent_uid", "updated", "post_uid"),
+        # supports paging through the comments on a post in thread order
+        db.Index("ix_post_parent_uid_path", "parent_uid", "path"),
+        # support the keyset paginated listing of root posts by their most recent
+        # comment in (last_comment_at, post_uid) order, for both kinds of viewers
+        db.Index(
+            "ix_post_parent_uid_active_last_comment_at_post_uid",
+            "parent_uid",
+            "active",
+            "last_comment_at",
+            "post_uid"
+        ),
+        db.Index("ix_post_parent_uid_last_comment_at_post_uid", "parent_uid", "last_comment_at", "post_uid"),
+    )
     post_uid = db.Column(db.String, primary_key=True, default=get_uuid)
     parent_uid = db.Column(db.String, db.ForeignKey("post.post_uid"), default=None)
+    # the post_uid of the thread's root post, a root post's own post_uid
+    root_uid = db.Column(db.String, index=True)
     sort_key = db.Column(db.Integer, nullable=False, unique=True, default=get_next_sort_key)
+    # the zero padded sort_keys from the root post down to this post, so a
+    # thread is a range of paths that sorts parents before their comments
+    path = db.Column(db.String, unique=True, index=True)
     user_uid = db.Column(db.String, db.ForeignKey("user.user_uid"), nullable=False, index=True)
     title = db.Column(db.String)
     content = db.Column(db.String)
+    excerpt = db.Column(db.String)
+    excerpt_html = db.Column(db.String)
+    excerpt_key = db.Column(db.String)
+    content_html = db.Column(db.String)
+    content_html_key = db.Column(db.String)
+    # the active comments in a root post's thread and when the newest of them was made
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default=text("0"))
+    last_comment_at = db.Column(db.DateTime)
     children = db.relationship("Post", backref=db.backref("parent", remote_side=[post_uid], lazy="joined"))
     active = db.Column(db.Boolean, nullable=False, default=True)
-    created = db.Column(db.DateTime, nullable=False, default=datetime.now(tz=timezone.utc))
-    updated = db.Column(db.DateTime, nullable=False, default=datetime.now(
-        tz=timezone.utc), onupdate=datetime.now(tz=timezone.utc))
+    created = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(tz=timezone.utc))
+    updated = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(tz=timezone.utc),
+        onupdate=lambda: datetime.now(tz=timezone.utc)
+    )
+
+    @staticmethod
+    def path_segment(sort_key):
+        """Formats a sort_key as a segment of a post path
+
+        Args:
+            sort_key (int): The sort_key of a post
+
+        Returns:
+            str: The zero padded path segment
+        """
+        return f"{sort_key:0{Post.PATH_SEGMENT_WIDTH}d}"
+
+    @staticmethod
+    def thread_path_range(root_path):
+        """Gets the range of paths covering a root post and all of
+        its comments, the range's end is the character after "."
+
+        Args:
+            root_path (str): The path of the root post
+
+        Returns:
+            tuple: The (start, end) range of the thread's paths, end excluded
+        """
+        return root_path, f"{root_path}/"
+
+    def update_excerpt(self):
+        """Rebuilds the stored listing excerpt from the post content
+        """
+        self.excerpt, self.excerpt_html = build_excerpt(self.content)
+        self.excerpt_key = markdown_key()
+
+    def update_content_html(self):
+        """Rebuilds the stored html of the post content, the html isn't
+        stored if the render pool was too busy to convert it
+
+        Returns:
+            Boolean: True if the html was stored, False otherwise
+        """
+        html, final = render_content(self.content)
+        self.content_html = html if final else None
+        self.content_html_key = content_key(self.content) if final else None
+        return final
 
     def __repr__(self):
         return f"""
         post_uid: {self.post_uid}
         parent_uid: {self.parent_uid}
+        root_uid: {self.root_uid}
         sort_key: {self.sort_key}
         title: {self.title}
         content: {self.content}
@@ -299,3 +814,124 @@ class Post(db.Model):
         created: {self.created}
         updated: {self.updated}
         """
+
+
+class PostCount(db.Model):
+    """The post count class holds running totals of the posts
+    matching the listing filters, so paginating a listing
+    doesn't have to count the posts on every page view
+    """
+    __tablename__ = "post_count"
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"""
+        name: {self.name}
+        value: {self.value}
+        """
+
+
+class SchemaVersion(db.Model):
+    """The schema version class holds the version of the tables and seed
+    data the database was last initialized with, so starting the
+    application can skip initializing a database that's up to date
+    """
+    __tablename__ = "schema_version"
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=lambda: datetime.now(tz=timezone.utc),
+        onupdate=lambda: datetime.now(tz=timezone.utc)
+    )
+
+    def __repr__(self):
+        return f"""
+        name: {self.name}
+        version: {self.version}
+        updated: {self.updated}
+        """
+
+
+class PendingNotification(db.Model):
+    """The pending notification class holds the comments on a followed post
+    that a follower hasn't been emailed about yet, one row per follower
+    and post, so a burst of comments becomes one digest email
+    """
+    __tablename__ = "pending_notification"
+    user_uid = db.Column(db.String, db.ForeignKey("user.user_uid"), primary_key=True)
+    post_uid = db.Column(db.String, db.ForeignKey("post.post_uid"), primary_key=True)
+    comment_count = db.Column(db.Integer, nullable=False, default=1)
+    # when the first comment of the digest was made, the digest is sent a window after it
+    first_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"""
+        user_uid: {self.user_uid}
+        post_uid: {self.post_uid}
+        comment_count: {self.comment_count}
+        first_at: {self.first_at}
+        last_at: {self.last_at}
+        """
+
+
+@db.event.listens_for(db.session, "before_flush")
+def _set_post_sort_keys(session, flush_context, instances):
+    """Gives the new posts their sort_keys before they're inserted,
+    so their paths can be built from them
+    """
+    posts = sorted(
+        (obj for obj in session.new if isinstance(obj, Post) and obj.sort_key is None),
+        key=lambda post: db.inspect(post).insert_order
+    )
+    if not posts:
+        return
+    for post, sort_key in zip(posts, sort_key_allocator.allocate(len(posts), session)):
+        post.sort_key = sort_key
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _share_sort_key_block(session):
+    """Shares the sort_key block reserved in the committed transaction
+    """
+    sort_key_allocator.transaction_committed(session)
+
+
+@db.event.listens_for(db.session, "after_transaction_end")
+def _drop_sort_key_block(session, transaction):
+    """Drops the sort_key block reserved in a transaction that ended
+    without committing
+    """
+    if transaction.parent is None:
+        sort_key_allocator.transaction_ended(session)
+
+
+@db.event.listens_for(Post, "before_insert")
+def _set_post_path(mapper, connection, target):
+    """Builds the materialized path of a new post from the path of
+    its parent post and its own sort_key, and copies the parent's
+    root_uid so the thread root is known without walking up to it
+    """
+    if target.sort_key is None:
+        target.sort_key = get_next_sort_key()
+    segment = Post.path_segment(target.sort_key)
+    if target.parent_uid is None:
+        # the post_uid default isn't applied until the insert runs
+        if target.post_uid is None:
+            target.post_uid = get_uuid()
+        target.path = segment
+        target.root_uid = target.post_uid
+        return
+    # is the parent being inserted in the same flush?
+    parent = target.__dict__.get("parent")
+    if parent is not None and parent.path is not None:
+        parent_path, parent_root_uid = parent.path, parent.root_uid
+    else:
+        parent_path, parent_root_uid = connection.execute(
+            select(Post.path, Post.root_uid).where(Post.post_uid == target.parent_uid)
+        ).one()
+    target.path = f"{parent_path}.{segment}"
+    target.root_uid = parent_root_uid
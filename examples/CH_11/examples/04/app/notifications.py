@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+
+from flask import current_app, has_request_context, url_for
+from sqlalchemy import delete, exists, literal, select, tuple_, update
+
+from . import db
+from .emailer import send_batch_mail
+from .models import db_session_manager, dialect_insert, PendingNotification, user_post, User
+
+logger = getLogger(__name__)
+
+# the follower emails are sent from here, so a comment on a
+# popular post doesn't hold up the request that created it
+_notification_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="notifications")
+
+# the email sent to the followers of a post when it gets a comment
+FOLLOWER_SUBJECT = "A post you're following has been updated"
+FOLLOWER_CONTENTS = """Hi {first_name},
+A blog post you're following has had a comment added to it. You can view
+that post here: {post_url}
+Thank you!
+"""
+
+# the digest email sent to a follower of a post that got comments
+DIGEST_SUBJECT = "Posts you're following have new comments"
+DIGEST_CONTENTS = """Hi {first_name},
+A blog post you're following has had {comment_count} comment(s) added to it. You can view
+that post here: {post_url}
+Thank you!
+"""
+
+# the notification delivery modes
+IMMEDIATE_MODE = "immediate"
+DIGEST_MODE = "digest"
+
+
+def iter_follower_chunks(db_session, post_uid, chunk_size):
+    """Streams the followers of a post from the database in chunks,
+    without loading User objects or all the followers at once
+
+    Args:
+        db_session (Session): The database session to use
+        post_uid (str): The post_uid of the followed root post
+        chunk_size (int): The number of followers in each chunk
+
+    Yields:
+        list: The (email, first_name) rows of a chunk of followers
+    """
+    result = db_session.execute(
+        select(User.email, User.first_name)
+        .join(user_post, user_post.c.user_uid == User.user_uid)
+        .where(user_post.c.post_uid == post_uid)
+        .execution_options(yield_per=chunk_size)
+    )
+    for chunk in result.partitions():
+        yield chunk
+
+
+def deliver_follower_chunk(chunk, post_url):
+    """The delivery stage of the follower notifications, sends
+    one batched email to a chunk of followers
+
+    Args:
+        chunk (list): The (email, first_name) rows of the followers
+        post_url (str): The url of the post that was commented on
+    """
+    send_batch_mail(
+        recipients=[
+            {"email": email, "params": {"first_name": first_name}}
+            for email, first_name in chunk
+        ],
+        subject=FOLLOWER_SUBJECT,
+        # each follower's first name is filled in by the email service
+        contents=FOLLOWER_CONTENTS.format(first_name="{{ params.first_name }}", post_url=post_url),
+    )
+
+
+def fan_out_follower_notifications(post_uid, post_url, deliver=deliver_follower_chunk):
+    """Sends the comment notification to every follower of a post,
+    a chunk of followers at a time
+
+    Args:
+        post_uid (str): The post_uid of the followed root post
+        post_url (str): The url of the post that was commented on
+        deliver (function): The delivery stage each chunk is handed to
+
+    Returns:
+        int: The number of followers notified
+    """
+    chunk_size = current_app.config.get("NOTIFICATION_CHUNK_SIZE", 500)
+    total = 0
+    with db_session_manager() as db_session:
+        for chunk in iter_follower_chunks(db_session, post_uid, chunk_size):
+            deliver(chunk, post_url)
+            total += len(chunk)
+    logger.debug(f"notified {total} followers of post {post_uid}")
+    return total
+
+
+def queue_digest_notifications(post_uid, now=None):
+    """Adds a comment on a post to the pending digest of every follower of
+    the post, with one INSERT ... SELECT that counts the comment on the
+    follower's existing pending row for the post if there is one
+
+    Args:
+        post_uid (str): The post_uid of the followed root post
+        now (datetime): The time of the comment, defaults to the current time
+
+    Returns:
+        int: The number of pending notifications added or updated
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    pending = PendingNotification.__table__
+    columns = ["user_uid", "post_uid", "comment_count", "first_at", "last_at"]
+    followers = select(
+        user_post.c.user_uid,
+        user_post.c.post_uid,
+        literal(1),
+        literal(now, db.DateTime),
+        literal(now, db.DateTime),
+    ).where(user_post.c.post_uid == post_uid)
+    with db_session_manager() as db_session:
+        insert = dialect_insert(db_session)
+        if insert is not None:
+            insert = insert(pending).from_select(columns, followers)
+            insert = insert.on_conflict_do_update(
+                index_elements=[pending.c.user_uid, pending.c.post_uid],
+                set_={
+                    "comment_count": pending.c.comment_count + 1,
+                    "last_at": insert.excluded.last_at,
+                }
+            )
+            rowcount = db_session.execute(insert).rowcount
+        else:
+            # the database can't update on conflict, so the followers' existing
+            # pending rows are updated first and the rest inserted
+            rowcount = db_session.execute(
+                update(pending)
+                .where(
+                    pending.c.post_uid == post_uid,
+                    pending.c.user_uid.in_(select(user_post.c.user_uid).where(user_post.c.post_uid == post_uid))
+                )
+                .values(comment_count=pending.c.comment_count + 1, last_at=now)
+            ).rowcount
+            rowcount += db_session.execute(
+                pending.insert().from_select(
+                    columns,
+                    followers.where(~exists().where(
+                        (pending.c.user_uid == user_post.c.user_uid) & (pending.c.post_uid == post_uid)
+                    ))
+                )
+            ).rowcount
+        db_session.commit()
+    logger.debug(f"queued {rowcount} digest notifications of post {post_uid}")
+    return rowcount
+
+
+def deliver_digest_chunk(chunk):
+    """The delivery stage of the digest notifications, sends one
+    batched email to a chunk of followers
+
+    Args:
+        chunk (list): The (email, first_name, comment_count, post_url) of the followers
+    """
+    send_batch_mail(
+        recipients=[
+            {
+                "email": email,
+                "params": {
+                    "first_name": first_name,
+                    "comment_count": comment_count,
+                    "post_url": post_url,
+                },
+            }
+            for email, first_name, comment_count, post_url in chunk
+        ],
+        subject=DIGEST_SUBJECT,
+        # each follower's details are filled in by the email service
+        contents=DIGEST_CONTENTS.format(
+            first_name="{{ params.first_name }}",
+            comment_count="{{ params.comment_count }}",
+            post_url="{{ params.post_url }}",
+        ),
+    )
+
+
+def _post_url(post_uid):
+    # the periodic flush runs outside of any request, so its
+    # urls are built for the configured notification server name
+    if has_request_context():
+        return url_for("content_bp.blog_post", post_uid=post_uid, _external=True)
+    adapter = current_app.url_map.bind(
+        current_app.config.get("NOTIFICATION_SERVER_NAME", "localhost:5000"),
+        url_scheme=current_app.config.get("PREFERRED_URL_SCHEME", "http"),
+    )
+    return adapter.build("content_bp.blog_post", {"post_uid": post_uid}, force_external=True)
+
+
+def flush_pending_notifications(now=None, deliver=deliver_digest_chunk):
+    """Sends the digests whose window has passed, a chunk of pending
+    notifications at a time, and removes them once they're sent. A
+    digest that gets another comment while it's being sent is kept
+    for the next flush
+
+    Args:
+        now (datetime): The time of the flush, defaults to the current time
+        deliver (function): The delivery stage each chunk is handed to
+
+    Returns:
+        int: The number of digests sent
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    window = timedelta(seconds=current_app.config.get("NOTIFICATION_DIGEST_WINDOW", 900))
+    chunk_size = current_app.config.get("NOTIFICATION_CHUNK_SIZE", 500)
+    pending = PendingNotification.__table__
+    total = 0
+    with db_session_manager() as db_session:
+        while True:
+            rows = db_session.execute(
+                select(
+                    pending.c.user_uid,
+                    pending.c.post_uid,
+                    pending.c.last_at,
+                    User.email,
+                    User.first_name,
+                    pending.c.comment_count,
+                )
+                .join(User, User.user_uid == pending.c.user_uid)
+                .where(pending.c.first_at <= now - window, pending.c.last_at <= now)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            deliver([
+                (email, first_name, comment_count, _post_url(post_uid))
+                for user_uid, post_uid, last_at, email, first_name, comment_count in rows
+            ])
+            # only the digests that didn't get another comment since they were read
+            db_session.execute(
+                delete(pending).where(
+                    tuple_(pending.c.user_uid, pending.c.post_uid, pending.c.last_at).in_(
+                        [(user_uid, post_uid, last_at) for user_uid, post_uid, last_at, *_ in rows]
+                    )
+                )
+            )
+            db_session.commit()
+            total += len(rows)
+    logger.debug(f"sent {total} digest notifications")
+    return total
+
+
+def notify_followers(post_uid, post_url):
+    """Queues the comment notification of the followers of a post,
+    to be sent outside the request, either right away or in the
+    followers' next digest depending on the notification_mode
+
+    Args:
+        post_uid (str): The post_uid of the followed root post
+        post_url (str): The url of the post that was commented on
+    """
+    app = current_app._get_current_object()
+    digest = app.config.get("NOTIFICATION_MODE", IMMEDIATE_MODE) == DIGEST_MODE
+    now = datetime.now(tz=timezone.utc)
+
+    def fan_out():
+        with app.app_context():
+            try:
+                if digest:
+                    queue_digest_notifications(post_uid, now)
+                else:
+                    fan_out_follower_notifications(post_uid, post_url)
+            except Exception:
+                logger.exception(f"Failed to notify the followers of post {post_uid}")
+
+    _notification_executor.submit(fan_out)
@@ -0,0 +1,129 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor from the query
+    string can't be decoded
+    """
+
+
+def encode_cursor(direction, sort_value, post_uid):
+    """Encodes the position of a post in a listing as an
+    opaque, url safe cursor string
+
+    Args:
+        direction (str): "next" or "prev", the direction to page from the position
+        sort_value (datetime): The sort column value of the post at the position
+        post_uid (str): The post_uid of the post at the position
+
+    Returns:
+        str: The opaque cursor string
+    """
+    data = json.dumps([direction, sort_value.isoformat(), post_uid], separators=(",", ":"))
+    return urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor string created by encode_cursor
+
+    Args:
+        cursor (str): The opaque cursor string
+
+    Raises:
+        InvalidCursor: If the cursor isn't a valid cursor string
+
+    Returns:
+        tuple: The (direction, sort_value, post_uid) of the cursor
+    """
+    try:
+        direction, sort_value, post_uid = json.loads(urlsafe_b64decode(cursor.encode("ascii")))
+        if direction not in ("next", "prev"):
+            raise InvalidCursor(f"Unknown cursor direction: {direction}")
+        return direction, datetime.fromisoformat(sort_value), post_uid
+    except (BinasciiError, UnicodeError, TypeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+class KeysetPagination:
+    """Holds one page of a keyset (seek) paginated listing. Unlike
+    offset pagination the page is located by the position of its
+    first or last item, so every page costs the same to query
+    no matter how deep into the listing it is
+    """
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, sort_column, uid_column, per_page, cursor=None):
+    """Paginates the query in descending (sort_column, uid_column) order
+    by seeking to the position in the cursor instead of using OFFSET.
+    The uid_column breaks ties between rows with equal sort values
+
+    Args:
+        query (Query): The filtered, unordered query to paginate
+        sort_column (Column): The column to order the listing by
+        uid_column (Column): The unique column used to break ties
+        per_page (int): The number of items per page
+        cursor (str, optional): The cursor of the page to get, None for the first page
+
+    Raises:
+        InvalidCursor: If the cursor isn't a valid cursor string
+
+    Returns:
+        KeysetPagination: The page of items and the cursors to the adjacent pages
+    """
+    direction = "next"
+    if cursor is not None:
+        direction, sort_value, uid = decode_cursor(cursor)
+        # a row value comparison seeks the (sort_column, uid_column) index
+        # to the position, the equivalent OR expression scans up to it
+        position = tuple_(sort_column, uid_column)
+        if direction == "next":
+            query = query.filter(position < tuple_(sort_value, uid))
+        else:
+            query = query.filter(position > tuple_(sort_value, uid))
+
+    # walk backwards through the index when paging to previous items
+    if direction == "next":
+        query = query.order_by(sort_column.desc(), uid_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), uid_column.asc())
+
+    # get one extra item to know if there are more items past this page
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == "prev":
+        items.reverse()
+    if not items:
+        return KeysetPagination(items)
+
+    def position(item):
+        return getattr(item, sort_column.key), getattr(item, uid_column.key)
+
+    next_cursor = prev_cursor = None
+    if direction == "next":
+        if has_more:
+            next_cursor = encode_cursor("next", *position(items[-1]))
+        if cursor is not None:
+            prev_cursor = encode_cursor("prev", *position(items[0]))
+    else:
+        next_cursor = encode_cursor("next", *position(items[-1]))
+        if has_more:
+            prev_cursor = encode_cursor("prev", *position(items[0]))
+    return KeysetPagination(items, next_cursor, prev_cursor)
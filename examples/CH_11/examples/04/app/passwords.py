@@ -0,0 +1,240 @@
+import os
+from concurrent.futures import TimeoutError
+from logging import getLogger
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+logger = getLogger(__name__)
+
+# the bcrypt cost used when the bcrypt_log_rounds setting is missing
+DEFAULT_LOG_ROUNDS = 12
+
+
+class PasswordPoolBusy(RuntimeError):
+    """Raised when a password can't be queued to the password pool
+    because the pool has the most passwords pending it allows
+    """
+
+
+def _hash_password(password, rounds):
+    # runs in the pool's worker processes
+    import bcrypt
+
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+
+
+def _check_password(hashed_password, password):
+    # runs in the pool's worker processes
+    import bcrypt
+
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode("utf-8")
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+    except ValueError:
+        # not a bcrypt hash
+        return False
+
+
+def hash_rounds(hashed_password):
+    """Gets the bcrypt cost a password hash was created with
+
+    Args:
+        hashed_password (str): The bcrypt hash, ex: "$2b$12$..."
+
+    Returns:
+        int: The log rounds of the hash, or None if it isn't a bcrypt hash
+    """
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode("utf-8", "replace")
+    parts = (hashed_password or "").split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+class PasswordPool:
+    """Hashes and checks passwords with bcrypt in a pool of worker processes,
+    so a burst of logins can't take up the CPU of the threads serving the
+    pages. The number of passwords waiting for or being worked on by the
+    pool is bounded, and the pool keeps statistics of its queue. A pool
+    of no workers hashes the passwords in the calling thread
+    """
+    def __init__(self, workers=0, max_pending=32, timeout=10.0, log_rounds=DEFAULT_LOG_ROUNDS):
+        self._lock = Lock()
+        self._executor = None
+        self._pid = os.getpid()
+        self.configure(workers, max_pending, timeout, log_rounds)
+
+    def configure(self, workers, max_pending, timeout, log_rounds):
+        """Sizes the pool, which shuts down its current worker processes,
+        new ones are started when the next password is queued
+
+        Args:
+            workers (int): The number of worker processes, 0 hashes in the calling thread
+            max_pending (int): The most passwords queued or being worked on at once
+            timeout (float): The seconds to wait for a place in the queue and the result together
+            log_rounds (int): The bcrypt cost of new password hashes
+        """
+        with self._lock:
+            self._shutdown()
+            self.workers = max(0, workers)
+            self.max_pending = max(1, max_pending)
+            self.timeout = timeout
+            self.log_rounds = log_rounds
+            self._slots = BoundedSemaphore(self.max_pending)
+            self.pending = 0
+            self.peak_pending = 0
+            self.completed = 0
+            self.rejected = 0
+            self.busy_seconds = 0.0
+
+    def hash_password(self, password):
+        """Hashes the password with the configured bcrypt cost
+
+        Args:
+            password (str): The password to hash
+
+        Returns:
+            str: The bcrypt hash of the password
+        """
+        if not password:
+            raise ValueError("Password must be non-empty.")
+        return self._run(_hash_password, password, self.log_rounds)
+
+    def check_password(self, hashed_password, password):
+        """Checks the password against its bcrypt hash
+
+        Args:
+            hashed_password (str): The bcrypt hash of the password
+            password (str): The password to check
+
+        Returns:
+            bool: True if the password matches the hash
+        """
+        if not hashed_password or not password:
+            return False
+        return self._run(_check_password, hashed_password, password)
+
+    def needs_rehash(self, hashed_password):
+        """Checks if the password hash was created with a
+        different bcrypt cost than the configured one
+
+        Args:
+            hashed_password (str): The bcrypt hash of a password
+
+        Returns:
+            bool: True if the password should be hashed again
+        """
+        return hash_rounds(hashed_password) != self.log_rounds
+
+    def stats(self):
+        """Gets the statistics of the pool's queue
+
+        Returns:
+            dict: The workers, pending, peak pending, maximum pending,
+                completed and rejected passwords and the mean seconds a
+                completed password took, including its time in the queue
+        """
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "peak_pending": self.peak_pending,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "mean_seconds": self.busy_seconds / self.completed if self.completed else 0.0,
+            }
+
+    def shutdown(self):
+        """Stops the pool's worker processes
+        """
+        with self._lock:
+            self._shutdown()
+
+    def _run(self, func, *args):
+        # one deadline covers waiting for a place in the queue and for the result
+        start = perf_counter()
+        deadline = start + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.rejected += 1
+            logger.warning(f"password pool busy, {self.max_pending} passwords pending")
+            raise PasswordPoolBusy(f"{self.max_pending} passwords pending")
+        with self._lock:
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+        try:
+            if self.workers == 0:
+                result = func(*args)
+            else:
+                future = self._get_executor().submit(func, *args)
+                try:
+                    result = future.result(timeout=max(0.0, deadline - perf_counter()))
+                except TimeoutError:
+                    future.cancel()
+                    with self._lock:
+                        self.rejected += 1
+                    raise PasswordPoolBusy(f"password not hashed within {self.timeout} seconds")
+            # only the passwords the pool finished count towards its mean time
+            with self._lock:
+                self.completed += 1
+                self.busy_seconds += perf_counter() - start
+            return result
+        finally:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+
+    def _get_executor(self):
+        with self._lock:
+            # a forked worker can't use its parent's worker processes
+            if self._pid != os.getpid():
+                self._executor = None
+                self._pid = os.getpid()
+            if self._executor is None:
+                # the multiprocessing modules are imported when the pool is first used
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # spawned workers don't inherit the web worker's threads or connections
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+                logger.info(f"password pool started with {self.workers} worker processes")
+            return self._executor
+
+    def _shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+
+# the pool the users' passwords are hashed and checked in
+password_pool = PasswordPool()
+
+
+def init_password_pool(app):
+    """Sizes the password pool from the application configuration, and
+    answers the requests that found the pool busy with a 503 error
+
+    Args:
+        app (Flask): The Flask app instance
+    """
+    password_pool.configure(
+        workers=app.config.get("PASSWORD_POOL_WORKERS", 0),
+        max_pending=app.config.get("PASSWORD_POOL_MAX_PENDING", 32),
+        timeout=app.config.get("PASSWORD_POOL_TIMEOUT", 10.0),
+        log_rounds=app.config.get("BCRYPT_LOG_ROUNDS", DEFAULT_LOG_ROUNDS)
+    )
+
+    @app.errorhandler(PasswordPoolBusy)
+    def password_pool_busy(e):
+        from werkzeug.exceptions import ServiceUnavailable
+
+        from . import error_page
+
+        body, status = error_page(ServiceUnavailable())
+        return body, status, {"Retry-After": "5"}
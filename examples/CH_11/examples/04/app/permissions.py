@@ -0,0 +1,100 @@
+from typing import NamedTuple, Optional
+
+from flask import g
+from flask_login import current_user, user_logged_in, user_logged_out
+
+from .models import Role
+
+# the permission bitmasks the content checks use, as plain integers
+_EDITOR_PERMISSIONS = (Role.Permissions.EDITOR | Role.Permissions.ADMINISTRATOR).value
+_ADMINISTRATOR_PERMISSIONS = Role.Permissions.ADMINISTRATOR.value
+
+
+class PermissionSnapshot(NamedTuple):
+    """The permissions of the current user, taken once per request
+    so checking them is integer arithmetic instead of walking
+    current_user.role_info and building Role.Permissions flags
+    """
+    user_uid: Optional[str]
+    raw_permissions: int
+
+    @property
+    def is_anonymous(self):
+        return self.user_uid is None
+
+    def has_any(self, permissions):
+        """Checks if the user has any of the permissions
+
+        Args:
+            permissions (Role.Permissions): The permission bitmask fields to check
+
+        Returns:
+            Boolean: True if the user has one of the permissions, False otherwise
+        """
+        return bool(self.raw_permissions & permissions.value)
+
+    @property
+    def is_editor(self):
+        return bool(self.raw_permissions & _EDITOR_PERMISSIONS)
+
+    @property
+    def is_administrator(self):
+        return bool(self.raw_permissions & _ADMINISTRATOR_PERMISSIONS)
+
+    @property
+    def views_active_posts_only(self):
+        return not self.raw_permissions & _EDITOR_PERMISSIONS
+
+    def owns(self, post):
+        """Checks if the user created the post
+
+        Args:
+            post (Post): The post to check
+
+        Returns:
+            Boolean: True if the user created the post, False otherwise
+        """
+        return self.user_uid is not None and self.user_uid == post.user_uid
+
+
+# the permissions of every anonymous user
+ANONYMOUS_PERMISSIONS = PermissionSnapshot(user_uid=None, raw_permissions=0)
+
+
+def current_permissions():
+    """Gets the permission snapshot of the current user, taking it
+    the first time it's needed in a request
+
+    Returns:
+        PermissionSnapshot: The current user's permissions
+    """
+    snapshot = g.get("permission_snapshot")
+    if snapshot is None:
+        if current_user.is_anonymous:
+            snapshot = ANONYMOUS_PERMISSIONS
+        else:
+            snapshot = PermissionSnapshot(current_user.user_uid, current_user.role_info.raw_permissions)
+        g.permission_snapshot = snapshot
+    return snapshot
+
+
+@user_logged_in.connect
+@user_logged_out.connect
+def _drop_permission_snapshot(sender, **kwargs):
+    """Retakes the permission snapshot if the user logs in or out during a request
+    """
+    g.pop("permission_snapshot", None)
+
+
+def viewer_permission_class():
+    """Gets the class of permissions the current user views
+    content with, so content rendered for one user can be
+    shared with other users seeing the same thing
+
+    Returns:
+        str: The permission class of the current user
+    """
+    permissions = current_permissions()
+    if permissions.is_anonymous:
+        return "anonymous"
+    return f"role:{permissions.raw_permissions}"
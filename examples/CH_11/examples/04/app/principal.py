@@ -0,0 +1,133 @@
+from time import time
+
+from flask import current_app, session
+from flask_login import UserMixin
+
+from .models import db_session_manager, role_registry
+
+# the session key the principal snapshot is kept under
+PRINCIPAL_SESSION_KEY = "principal"
+
+
+class Principal(UserMixin):
+    """A minimal snapshot of a logged in user, kept in the signed session
+    cookie so most requests don't have to load the user from the database.
+    It only has what the requests need to know about the current user,
+    routes that change the user load the User from the database
+    """
+    def __init__(self, user_uid, first_name, last_name, role_uid, raw_permissions,
+                 confirmed, active, security_stamp, cached_at):
+        self.user_uid = user_uid
+        self.first_name = first_name
+        self.last_name = last_name
+        self.role_uid = role_uid
+        self.raw_permissions = raw_permissions
+        self.confirmed = confirmed
+        self.active = active
+        self.security_stamp = security_stamp
+        self.cached_at = cached_at
+
+    def get_id(self):
+        return self.user_uid
+
+    @property
+    def is_active(self):
+        return self.active
+
+    @property
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+    @property
+    def role_info(self):
+        return role_registry.by_uid(self.role_uid)
+
+
+def _principal_cache_enabled():
+    return current_app.config.get("PRINCIPAL_CACHE_ENABLED", False)
+
+
+def cached_principal(user_uid):
+    """Gets the principal snapshot of the user from the session,
+    if it's for the user and hasn't expired
+
+    Args:
+        user_uid (str): The user_uid of the logged in user
+
+    Returns:
+        Principal: The snapshot of the user, or None if the user has to be loaded
+    """
+    if not _principal_cache_enabled():
+        return None
+    snapshot = session.get(PRINCIPAL_SESSION_KEY)
+    if snapshot is None or snapshot.get("user_uid") != user_uid:
+        return None
+    if time() - snapshot.get("cached_at", 0) > current_app.config.get("PRINCIPAL_CACHE_TTL", 300):
+        return None
+    try:
+        return Principal(**snapshot)
+    # a snapshot from an older version of the application
+    except TypeError:
+        return None
+
+
+def is_principal_revoked(user):
+    """Checks if the user's security stamp changed since their principal
+    snapshot was taken, because their password was changed or they were
+    deactivated, in which case their session is no longer valid
+
+    Args:
+        user (User): The user loaded from the database
+
+    Returns:
+        Boolean: True if the snapshot is for the user and its stamp is stale
+    """
+    snapshot = session.get(PRINCIPAL_SESSION_KEY)
+    return (
+        snapshot is not None
+        and snapshot.get("user_uid") == user.user_uid
+        and snapshot.get("security_stamp") != user.security_stamp
+    )
+
+
+def remember_principal(user):
+    """Keeps a principal snapshot of the user in the session
+
+    Args:
+        user (User): The user loaded from the database
+    """
+    if not _principal_cache_enabled():
+        return
+    session[PRINCIPAL_SESSION_KEY] = dict(
+        user_uid=user.user_uid,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        role_uid=user.role_uid,
+        raw_permissions=user.role_info.raw_permissions,
+        confirmed=bool(user.confirmed),
+        active=bool(user.active),
+        security_stamp=user.security_stamp,
+        cached_at=time(),
+    )
+
+
+def forget_principal():
+    """Removes the principal snapshot from the session
+    """
+    session.pop(PRINCIPAL_SESSION_KEY, None)
+
+
+def init_role_registry(app):
+    """Sets how often the role registry checks for changes to the roles,
+    and checks before each request, so the workers pick up the roles
+    "flask myblog init-db" changed without restarting
+
+    Args:
+        app (Flask): The Flask app instance
+    """
+    role_registry.configure(app.config.get("ROLE_REGISTRY_CHECK_INTERVAL", 30.0))
+
+    @app.before_request
+    def refresh_role_registry():
+        with db_session_manager(session_close=False) as db_session:
+            role_registry.refresh(db_session)
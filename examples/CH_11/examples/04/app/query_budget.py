@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from logging import getLogger
+from threading import local
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+
+from . import db
+
+logger = getLogger(__name__)
+
+# the query counters active in the current thread
+_counters = local()
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Raised when a route runs more database queries than its budget
+    """
+
+
+class QueryCounter:
+    """Counts the database queries run while it's active
+    """
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+
+@contextmanager
+def count_queries():
+    """Creates a context manager counting the database
+    queries run in the current thread within its scope
+
+    Yields:
+        QueryCounter: The counter of the queries
+    """
+    counter = QueryCounter()
+    stack = _counters.__dict__.setdefault("stack", [])
+    stack.append(counter)
+    try:
+        yield counter
+    finally:
+        stack.remove(counter)
+
+
+@contextmanager
+def assert_query_budget(budget):
+    """Creates a context manager that fails if more than the
+    budgeted number of database queries run within its scope,
+    for use in tests of the routes
+
+    Args:
+        budget (int): The maximum number of queries allowed
+
+    Raises:
+        QueryBudgetExceeded: If more queries than the budget were run
+    """
+    with count_queries() as counter:
+        yield counter
+    if counter.count > budget:
+        statements = "\n".join(counter.statements)
+        raise QueryBudgetExceeded(f"{counter.count} queries run, budget is {budget}:\n{statements}")
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_counters, "stack", []):
+        counter.count += 1
+        counter.statements.append(statement)
+    if has_app_context() and "query_count" in g:
+        g.query_count += 1
+
+
+def get_query_budget(method, endpoint):
+    """Gets the query budget configured for requests to the endpoint
+
+    Args:
+        method (str): The HTTP method of the requests, ex: "GET"
+        endpoint (str): The endpoint name, ex: "content_bp.blog_posts"
+
+    Returns:
+        int: The most queries the requests should run, or None if there's no budget
+    """
+    return current_app.config.get("QUERY_BUDGETS", {}).get(f"{method} {endpoint}")
+
+
+def init_query_budget(app):
+    """Counts the database queries each request runs and logs the requests
+    running more than the query_budgets configured for their method and
+    endpoint, "flask myblog check-query-budgets" fails on them instead
+
+    Args:
+        app (Flask): The Flask app instance
+    """
+    event.listen(db.engine, "before_cursor_execute", _count_query)
+
+    @app.before_request
+    def start_query_count():
+        g.query_count = 0
+
+    @app.after_request
+    def check_query_budget(response):
+        budget = get_query_budget(request.method, request.endpoint)
+        if budget is not None and g.get("query_count", 0) > budget:
+            logger.warning(f"{request.method} {request.endpoint} ran {g.query_count} queries, budget is {budget}")
+        return response
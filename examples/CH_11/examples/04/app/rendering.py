@@ -0,0 +1,304 @@
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError
+from html import unescape
+from logging import getLogger
+from threading import local, Lock
+
+import bleach
+from flask import current_app
+from markupsafe import escape
+
+logger = getLogger(__name__)
+
+# the length of the post content shown on the blog posts listing cards
+EXCERPT_LENGTH = 100
+
+# a small pool to render markdown in, so a pathological post can only tie
+# up one of these threads and not the worker handling the request
+_render_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="markdown")
+
+# the renders queued or running in the render pool by their content key,
+# so the views of a post while it's being rendered wait on the same render
+_renders = {}
+_renders_lock = Lock()
+
+
+class MarkdownRenderer(ABC):
+    """The base of the markdown renderers the markdown_renderer
+    setting chooses from, the renderers import their markdown
+    package when they're first used, not at startup
+
+    Args:
+        extensions (tuple): The python-markdown extension names configured
+    """
+    name = None
+    # True if the renderer follows the CommonMark spec
+    commonmark = False
+
+    def __init__(self, extensions=()):
+        self.extensions = tuple(extensions)
+
+    @abstractmethod
+    def render(self, content):
+        """Converts the markdown content to html
+
+        Args:
+            content (str): The markdown content
+
+        Returns:
+            str: The html version of the content
+        """
+
+    @abstractmethod
+    def version(self):
+        """Gets the version of the markdown package, part of the
+        fingerprint of the stored html the renderer creates
+
+        Returns:
+            str: The version of the markdown package
+        """
+
+
+class PythonMarkdownRenderer(MarkdownRenderer):
+    """Renders with python-markdown, reusing a converter per
+    thread as the converters aren't thread safe
+    """
+    name = "python-markdown"
+
+    def __init__(self, extensions=()):
+        super().__init__(extensions)
+        self._local = local()
+
+    def render(self, content):
+        converter = getattr(self._local, "converter", None)
+        if converter is None:
+            import markdown
+
+            converter = self._local.converter = markdown.Markdown(extensions=list(self.extensions))
+        return converter.reset().convert(content)
+
+    def version(self):
+        from markdown import __version__
+
+        return __version__
+
+
+class CmarkRenderer(MarkdownRenderer):
+    """Renders CommonMark with cmarkgfm, the bindings of cmark, the C
+    reference implementation of CommonMark, which keeps no state
+    between conversions so it's used by all the threads at once
+    """
+    name = "cmark"
+    commonmark = True
+
+    # the cmark extensions matching the python-markdown extensions
+    EXTENSION_NAMES = {
+        "tables": ("table",),
+        "markdown.extensions.tables": ("table",),
+        "extra": ("table",),
+        "markdown.extensions.extra": ("table",),
+    }
+
+    def __init__(self, extensions=()):
+        super().__init__(extensions)
+        self._extension_names = sorted({
+            name for extension in self.extensions for name in self.EXTENSION_NAMES.get(extension, ())
+        })
+
+    def render(self, content):
+        import cmarkgfm
+        from cmarkgfm.cmark import Options
+
+        # raw html is kept like python-markdown does, the form filters already escaped it
+        if self._extension_names:
+            return cmarkgfm.markdown_to_html_with_extensions(
+                content, options=Options.CMARK_OPT_UNSAFE, extensions=self._extension_names
+            )
+        return cmarkgfm.markdown_to_html(content, options=Options.CMARK_OPT_UNSAFE)
+
+    def version(self):
+        from importlib.metadata import version
+
+        return version("cmarkgfm")
+
+
+# the markdown renderers by their markdown_renderer setting name
+MARKDOWN_RENDERERS = {
+    renderer.name: renderer
+    for renderer in (PythonMarkdownRenderer, CmarkRenderer)
+}
+
+# the default renderer, the one the stored post html was first rendered with
+DEFAULT_MARKDOWN_RENDERER = PythonMarkdownRenderer.name
+
+# the renderers created, by their name and extensions
+_renderers = {}
+
+
+def get_renderer(name=None, extensions=None):
+    """Gets the markdown renderer, by default the one configured
+    by the markdown_renderer and markdown_extensions settings
+
+    Args:
+        name (str): The name of the renderer, ex: "cmark"
+        extensions (list): The python-markdown extension names
+
+    Returns:
+        MarkdownRenderer: The renderer
+    """
+    if name is None:
+        name = current_app.config.get("MARKDOWN_RENDERER", DEFAULT_MARKDOWN_RENDERER)
+    if extensions is None:
+        extensions = current_app.config.get("MARKDOWN_EXTENSIONS", [])
+    key = (name, tuple(extensions))
+    renderer = _renderers.get(key)
+    if renderer is None:
+        if name not in MARKDOWN_RENDERERS:
+            raise ValueError(f"unknown markdown renderer {name!r}, expected one of {sorted(MARKDOWN_RENDERERS)}")
+        renderer = _renderers.setdefault(key, MARKDOWN_RENDERERS[name](extensions))
+    return renderer
+
+
+def render_markdown(content):
+    """Converts markdown content to html using the markdown
+    renderer and extensions configured for the application
+
+    Args:
+        content (str): The markdown content
+
+    Returns:
+        str: The html version of the content
+    """
+    return get_renderer().render(content)
+
+
+def markdown_fingerprint():
+    """Creates a fingerprint of the markdown configuration, so stored
+    html rendered with a different configuration can be detected
+
+    Returns:
+        str: The fingerprint of the markdown configuration
+    """
+    renderer = get_renderer()
+    fingerprint = [renderer.version(), list(renderer.extensions)]
+    # html stored before the renderer was configurable has no renderer name
+    if renderer.name != DEFAULT_MARKDOWN_RENDERER:
+        fingerprint.append(renderer.name)
+    return json.dumps(fingerprint)
+
+
+def markdown_key():
+    """Creates the key identifying html rendered with the current markdown
+    configuration, for stored html like the excerpts that's rebuilt
+    whenever its content changes, so only the configuration can make it stale
+
+    Returns:
+        str: The hex digest key of the markdown configuration
+    """
+    return hashlib.sha256(markdown_fingerprint().encode("utf-8")).hexdigest()
+
+
+def content_key(content):
+    """Creates the key identifying the rendered html of the content
+    with the current markdown configuration
+
+    Args:
+        content (str): The markdown content
+
+    Returns:
+        str: The hex digest key of the content and markdown configuration
+    """
+    key = hashlib.sha256(markdown_fingerprint().encode("utf-8"))
+    key.update(b"\0")
+    key.update((content or "").encode("utf-8"))
+    return key.hexdigest()
+
+
+def render_content(content):
+    """Converts the full markdown content of a post to html, guarding
+    against content too large or too slow to convert. Guarded content
+    is shown as escaped preformatted text instead, and is final so it's
+    stored, as the render thread of content that timed out can't be
+    stopped and mustn't be tied up again by the next view of the post
+
+    Args:
+        content (str): The markdown content of the post
+
+    Returns:
+        tuple: The (html, final) result, final is False if the render pool
+            was too busy to start the conversion in time, so the
+            preformatted html returned shouldn't be stored
+    """
+    if content is None:
+        return None, True
+    max_size = current_app.config.get("MARKDOWN_MAX_SOURCE_SIZE", 256 * 1024)
+    if len(content) > max_size:
+        logger.warning(f"markdown content of {len(content)} characters not converted, over {max_size}")
+        return _preformatted(content), True
+    timeout = current_app.config.get("MARKDOWN_RENDER_TIMEOUT", 2.0)
+    key = content_key(content)
+    with _renders_lock:
+        future = _renders.get(key)
+        submitted = future is None
+        if submitted:
+            future = _renders[key] = _render_executor.submit(get_renderer().render, content)
+    if submitted:
+        future.add_done_callback(lambda done: _forget_render(key, done))
+    try:
+        return future.result(timeout=timeout), True
+    except CancelledError:
+        return _preformatted(content), False
+    except TimeoutError:
+        # a conversion that didn't start is dropped, the pool was busy
+        if future.cancel():
+            logger.warning(f"markdown conversion not started within {timeout} seconds")
+            return _preformatted(content), False
+        logger.warning(f"markdown conversion timed out after {timeout} seconds")
+        return _preformatted(content), True
+
+
+def _forget_render(key, future):
+    with _renders_lock:
+        if _renders.get(key) is future:
+            del _renders[key]
+
+
+def _preformatted(content):
+    # the content is already html escaped by the form filters
+    return f"<pre>{escape(unescape(content))}</pre>"
+
+
+def truncate_text(text, length=EXCERPT_LENGTH, end="...", leeway=5):
+    """Truncates the text at a word boundary the same way
+    the Jinja truncate filter does
+
+    Args:
+        text (str): The text to truncate
+        length (int): The maximum length of the truncated text
+        end (str): The string appended to truncated text
+        leeway (int): How far the text can exceed the length before it's truncated
+
+    Returns:
+        str: The truncated text
+    """
+    if len(text) <= length + leeway:
+        return text
+    return text[:length - len(end)].rsplit(" ", 1)[0] + end
+
+
+def build_excerpt(content):
+    """Builds the listing card excerpt of a post's markdown content
+
+    Args:
+        content (str): The markdown content of the post
+
+    Returns:
+        tuple: The (plain text, html) excerpt of the content
+    """
+    if content is None:
+        return None, None
+    excerpt_html = render_markdown(truncate_text(content))
+    excerpt = unescape(bleach.clean(excerpt_html, tags=[], strip=True)).strip()
+    return excerpt, excerpt_html
@@ -0,0 +1,108 @@
+from functools import wraps
+from logging import getLogger
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event
+
+from .cache import TaggedCache
+from .models import Post
+
+logger = getLogger(__name__)
+
+# the cache holding the rendered responses served to anonymous users
+response_cache = TaggedCache()
+
+# the tag of every cached blog posts listing page
+POSTS_LISTING_TAG = "posts"
+
+# the response headers kept with a cached response
+CACHED_HEADERS = ("ETag", "Last-Modified", "Cache-Control", "Vary")
+
+
+def init_response_cache(app):
+    """Sizes the response cache from the application configuration
+
+    Args:
+        app (Flask): The Flask app instance
+    """
+    response_cache.configure(
+        maxsize=app.config.get("RESPONSE_CACHE_MAXSIZE", 1024),
+        ttl=app.config.get("RESPONSE_CACHE_TTL", 60)
+    )
+
+
+def tag_response(*tags):
+    """Tags the response being rendered, so it's invalidated in the
+    response cache when anything with one of the tags changes
+
+    Args:
+        tags: The tags of the response, the post_uids of the posts in it
+    """
+    if "response_cache_tags" in g:
+        g.response_cache_tags.update(tags)
+
+
+def _is_cacheable():
+    config = current_app.config
+    return (
+        config.get("RESPONSE_CACHE_ENABLED", True)
+        and request.method == "GET"
+        and request.endpoint not in config.get("RESPONSE_CACHE_EXCLUDED_ENDPOINTS", [])
+        and request.args.get("action") is None
+        and current_user.is_anonymous
+        # pending flash messages are part of the page
+        and "_flashes" not in session
+    )
+
+
+def cache_anonymous_response(func):
+    """Decorator serving the pre-rendered response of the route to
+    anonymous users, keyed by the URL path and query string
+
+    Args:
+        func (function): The route function to cache
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _is_cacheable():
+            return func(*args, **kwargs)
+        key = request.full_path
+        cached = response_cache.get(key)
+        if cached is not None:
+            body, mimetype, headers = cached
+            response = current_app.response_class(body, mimetype=mimetype, headers=headers)
+            response.make_conditional(request)
+            response.headers["X-Cache"] = "HIT"
+            logger.debug(f"response cache hit: {key}")
+            return response
+        g.response_cache_tags = set()
+        response = make_response(func(*args, **kwargs))
+        if response.status_code == 200 and g.response_cache_tags:
+            headers = {
+                name: response.headers[name]
+                for name in CACHED_HEADERS
+                if name in response.headers
+            }
+            response_cache.set(
+                key,
+                (response.get_data(), response.mimetype, headers),
+                tags=g.response_cache_tags
+            )
+        response.headers["X-Cache"] = "MISS"
+        logger.debug(f"response cache miss: {key}")
+        return response
+    return wrapper
+
+
+@event.listens_for(Post, "after_insert")
+@event.listens_for(Post, "after_update")
+def _invalidate_post_responses(mapper, connection, target):
+    """Drops the cached responses showing a post when it changes,
+    a new comment drops the responses showing its parent post, the
+    page of its thread and the listings showing the thread statistics
+    """
+    tags = [target.post_uid, POSTS_LISTING_TAG]
+    if target.parent_uid is not None:
+        tags.extend((target.parent_uid, target.root_uid))
+    response_cache.invalidate(*tags)
@@ -0,0 +1,221 @@
+from logging import getLogger
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateColumn
+
+from . import db
+from .models import (
+    db_session_manager,
+    Role,
+    role_registry,
+    SchemaVersion,
+    sort_key_allocator,
+    SortKeySequence,
+    user_post,
+)
+
+logger = getLogger(__name__)
+
+# the version of the tables and seed data, bump it when they change so
+# the databases initialized with an older version are initialized again
+SCHEMA_VERSION = 7
+
+# the columns added to the tables after they were first created, with the
+# command filling them in on the existing rows. db.create_all() only creates
+# missing tables, so init_db adds these to the tables that already exist
+ADDED_COLUMNS = (
+    # the backfills of the later columns need the root_uids and paths
+    ("post", "root_uid", "backfill-root-uids"),
+    ("post", "path", "backfill-paths"),
+    ("post", "excerpt", "backfill-excerpts"),
+    ("post", "excerpt_html", "backfill-excerpts"),
+    ("post", "excerpt_key", "backfill-excerpts"),
+    # the html is rendered and stored when a post is first viewed
+    ("post", "content_html", None),
+    ("post", "content_html_key", None),
+    ("post", "comment_count", "reconcile-thread-stats"),
+    ("post", "last_comment_at", "reconcile-thread-stats"),
+    # users without a stamp are given one by their next password, role or active change
+    ("user", "security_stamp", None),
+)
+
+# the indexes replaced by other indexes, dropped from the existing tables
+DROPPED_INDEXES = (
+    "ix_post_parent_uid_active_updated",
+    "ix_post_parent_uid_active_last_comment_at",
+)
+
+# the name of the schema_version row of the MyBlog tables
+SCHEMA_NAME = "myblog"
+
+
+def get_schema_version():
+    """Gets the version the database was last initialized with
+
+    Returns:
+        int: The stored schema version, or None if the database hasn't been initialized
+    """
+    try:
+        with db_session_manager() as db_session:
+            return (
+                db_session
+                .query(SchemaVersion.version)
+                .filter(SchemaVersion.name == SCHEMA_NAME)
+                .scalar()
+            )
+    # the schema_version table doesn't exist yet
+    except (OperationalError, ProgrammingError):
+        return None
+
+
+def add_missing_columns():
+    """Adds the ADDED_COLUMNS missing from the existing tables
+
+    Returns:
+        list: The commands to run to fill in the added columns, in order
+    """
+    backfills = []
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        preparer = connection.dialect.identifier_preparer
+        for table_name, column_name, backfill in ADDED_COLUMNS:
+            # a table created by db.create_all() has all its columns
+            if not inspector.has_table(table_name):
+                continue
+            if column_name in {column["name"] for column in inspector.get_columns(table_name)}:
+                continue
+            table = db.metadata.tables[table_name]
+            column = CreateColumn(table.c[column_name]).compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column}"))
+            logger.info(f"column {table_name}.{column_name} added")
+            if backfill is not None and backfill not in backfills:
+                backfills.append(backfill)
+    return backfills
+
+
+def add_unique_follows():
+    """Makes the follows in a user_post table created before the table had
+    a primary key unique, removing the duplicate follows and adding the
+    unique index the follow upsert's conflict target needs, in place of the
+    primary key the existing table can't gain
+
+    Returns:
+        int: The number of duplicate follows removed
+    """
+    inspector = inspect(db.engine)
+    if not inspector.has_table(user_post.name):
+        return 0
+    follow_columns = {"user_uid", "post_uid"}
+    if set(inspector.get_pk_constraint(user_post.name)["constrained_columns"]) == follow_columns:
+        return 0
+    for index in inspector.get_indexes(user_post.name):
+        if index["unique"] and set(index["column_names"]) == follow_columns:
+            return 0
+    with db.engine.begin() as connection:
+        duplicates = connection.execute(
+            select(user_post.c.user_uid, user_post.c.post_uid)
+            .group_by(user_post.c.user_uid, user_post.c.post_uid)
+            .having(func.count() > 1)
+        ).all()
+        for user_uid, post_uid in duplicates:
+            follow = (user_post.c.user_uid == user_uid) & (user_post.c.post_uid == post_uid)
+            connection.execute(user_post.delete().where(follow))
+            connection.execute(user_post.insert().values(user_uid=user_uid, post_uid=post_uid))
+        # the follower lookup index is made unique rather than adding another one
+        connection.execute(text("DROP INDEX IF EXISTS ix_user_post_post_uid_user_uid"))
+        connection.execute(text(
+            "CREATE UNIQUE INDEX ix_user_post_post_uid_user_uid ON user_post (post_uid, user_uid)"
+        ))
+    logger.info(f"{len(duplicates)} duplicate follows removed, follows made unique")
+    return len(duplicates)
+
+
+def create_missing_indexes():
+    """Creates the indexes missing from the existing tables, which
+    db.create_all() only creates along with a new table, and drops
+    the DROPPED_INDEXES
+    """
+    with db.engine.begin() as connection:
+        for name in DROPPED_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def init_db(app):
+    """Creates the missing tables and indexes, seeds the lookup tables and
+    totals, and stores the schema version, this is the DDL and seed work
+    run once per deployment by "flask myblog init-db". The columns added
+    to existing tables need their backfill commands run afterwards
+
+    Args:
+        app (Flask): The Flask app instance
+
+    Returns:
+        list: The backfill commands to run for the columns added, in order
+    """
+    from .counts import init_post_counts
+    from .search import init_search_index
+
+    db.create_all()
+    backfills = add_missing_columns()
+    add_unique_follows()
+    create_missing_indexes()
+    SortKeySequence.initialize_sequence(app.config.get("SORT_KEY_BLOCK_SIZE", 1))
+    init_search_index()
+    init_post_counts()
+    Role.initialize_role_table()
+    with db_session_manager() as db_session:
+        schema_version = db_session.query(SchemaVersion).get(SCHEMA_NAME)
+        if schema_version is None:
+            schema_version = SchemaVersion(name=SCHEMA_NAME)
+            db_session.add(schema_version)
+        schema_version.version = SCHEMA_VERSION
+        db_session.commit()
+    logger.info(f"database initialized with schema version {SCHEMA_VERSION}")
+    for backfill in backfills:
+        logger.warning(f"run 'flask myblog {backfill}' to fill in the columns added to the existing rows")
+    return backfills
+
+
+def load_schema_state(app):
+    """Loads the in-process state that comes from the database, without
+    changing the database
+
+    Args:
+        app (Flask): The Flask app instance
+    """
+    from .search import init_search_index
+
+    sort_key_allocator.configure(app.config.get("SORT_KEY_BLOCK_SIZE", 1))
+    init_search_index(create=False)
+    with db_session_manager() as db_session:
+        role_registry.load(db_session)
+
+
+def init_schema(app):
+    """Checks the database schema version when the application starts. An
+    up to date database only has its in-process state loaded, otherwise the
+    database is initialized if the auto_init_db setting is on, which
+    the production workers leave to "flask myblog init-db"
+
+    Args:
+        app (Flask): The Flask app instance
+    """
+    version = get_schema_version()
+    if version == SCHEMA_VERSION and not app.config.get("FORCE_INIT_DB", False):
+        load_schema_state(app)
+        return
+    if app.config.get("AUTO_INIT_DB", True):
+        init_db(app)
+        return
+    logger.error(
+        f"database schema version is {version}, expected {SCHEMA_VERSION}, "
+        "run 'flask myblog init-db' to initialize it"
+    )
+    try:
+        load_schema_state(app)
+    except (OperationalError, ProgrammingError) as e:
+        logger.error(f"database isn't initialized: {e}")
@@ -0,0 +1,181 @@
+from html import unescape
+from logging import getLogger
+
+from markupsafe import Markup, escape
+from sqlalchemy import false, Float, String, event, inspect, null, or_, text
+from sqlalchemy.exc import OperationalError
+
+from . import db
+from .models import Post
+
+logger = getLogger(__name__)
+
+# is the SQLite FTS5 full text search index available to search with?
+fts_enabled = False
+
+# markers SQLite puts around the matched terms in a snippet, they're
+# replaced with <mark> tags after the snippet text is html escaped
+SNIPPET_MATCH_START = "\x02"
+SNIPPET_MATCH_END = "\x03"
+
+
+def init_search_index(create=True):
+    """Creates the FTS5 virtual table mirroring the title and content
+    of all the root posts, populating it from the post table if it
+    doesn't exist yet or is missing posts. Whether the viewer sees
+    inactive posts is filtered when searching. Search falls back to
+    LIKE queries if the database isn't SQLite or SQLite wasn't built
+    with FTS5
+
+    Args:
+        create (bool): Create and populate the table if necessary,
+            otherwise only check if it exists to search with
+    """
+    global fts_enabled
+    fts_enabled = False
+    if db.engine.dialect.name != "sqlite":
+        logger.info("full text search index not supported, using LIKE search")
+        return
+    try:
+        with db.engine.begin() as connection:
+            exists = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_fts'")
+            ).scalar()
+            if exists is None and not create:
+                logger.info("full text search index not created, using LIKE search")
+                return
+            if exists is None:
+                connection.execute(text(
+                    "CREATE VIRTUAL TABLE post_fts USING fts5("
+                    "post_uid UNINDEXED, title, content, tokenize = 'porter unicode61')"
+                ))
+                logger.info("full text search index created")
+            if create:
+                _populate_search_index(connection)
+        fts_enabled = True
+    except OperationalError as e:
+        logger.warning(f"full text search index not available, using LIKE search: {e}")
+
+
+def _populate_search_index(connection):
+    # indexes created before inactive posts were indexed are rebuilt
+    indexed = connection.execute(text("SELECT count(*) FROM post_fts")).scalar()
+    root_posts = connection.execute(text("SELECT count(*) FROM post WHERE parent_uid IS NULL")).scalar()
+    if indexed == root_posts:
+        return
+    connection.execute(text("DELETE FROM post_fts"))
+    connection.execute(text(
+        "INSERT INTO post_fts(rowid, post_uid, title, content) "
+        "SELECT rowid, post_uid, title, content FROM post WHERE parent_uid IS NULL"
+    ))
+    logger.info(f"full text search index populated with {root_posts} posts")
+
+
+@event.listens_for(Post, "after_insert")
+@event.listens_for(Post, "after_update")
+def _sync_search_index(mapper, connection, target):
+    """Keeps the search index in step with the root posts in the same
+    transaction as the change. The index rowid is the post table
+    rowid so the index row can be found without a scan
+    """
+    if not fts_enabled or target.parent_uid is not None:
+        return
+    state = inspect(target)
+    if not any(state.attrs[name].history.has_changes() for name in ("title", "content")):
+        return
+    params = {"post_uid": target.post_uid}
+    connection.execute(
+        text("DELETE FROM post_fts WHERE rowid = (SELECT rowid FROM post WHERE post_uid = :post_uid)"),
+        params
+    )
+    connection.execute(
+        text(
+            "INSERT INTO post_fts(rowid, post_uid, title, content) "
+            "SELECT rowid, post_uid, title, content FROM post WHERE post_uid = :post_uid"
+        ),
+        params
+    )
+
+
+def _match_expression(search):
+    """Quotes each search term so characters in the user's search
+    string aren't interpreted as FTS5 query syntax
+
+    Args:
+        search (str): The search string from the user
+
+    Returns:
+        str: The FTS5 MATCH expression matching all the terms, empty if there are no terms
+    """
+    terms = search.replace('"', " ").split()
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def search_posts(posts, search):
+    """Restricts the posts query to the posts matching the search terms
+    in their title or content. With the FTS5 index the results are
+    ordered by BM25 rank and come with a highlighted snippet, otherwise
+    a LIKE query is used and the results are ordered by most recent. A
+    search without any terms, ex: only quotes, finds no posts
+
+    Args:
+        posts (Query): The filtered query of posts to search in
+        search (str): The search string from the user
+
+    Returns:
+        Query: The query returning (Post, snippet) tuples
+    """
+    if not fts_enabled:
+        like = f"%{search}%"
+        return (
+            posts
+            .add_columns(null().label("snippet"))
+            .filter(or_(Post.title.like(like), Post.content.like(like)))
+            .order_by(Post.updated.desc())
+        )
+    match = _match_expression(search)
+    if not match:
+        return posts.add_columns(null().label("snippet")).filter(false())
+    matches = (
+        text(
+            "SELECT post_uid, bm25(post_fts) AS rank, "
+            "snippet(post_fts, -1, :match_start, :match_end, '...', 24) AS snippet "
+            "FROM post_fts WHERE post_fts MATCH :match"
+        )
+        .bindparams(
+            match=match,
+            match_start=SNIPPET_MATCH_START,
+            match_end=SNIPPET_MATCH_END,
+        )
+        .columns(post_uid=String, rank=Float, snippet=String)
+        .subquery("post_search")
+    )
+    return (
+        posts
+        .join(matches, matches.c.post_uid == Post.post_uid)
+        .add_columns(matches.c.snippet)
+        .order_by(matches.c.rank)
+    )
+
+
+def attach_snippets(items):
+    """Converts the (Post, snippet) tuples from a search into posts
+    with a search_snippet attribute holding the highlighted snippet
+
+    Args:
+        items (list): The (Post, snippet) tuples from search_posts
+
+    Returns:
+        list: The posts
+    """
+    posts = []
+    for post, snippet in items:
+        if snippet is not None:
+            snippet = (
+                str(escape(unescape(snippet)))
+                .replace(SNIPPET_MATCH_START, "<mark>")
+                .replace(SNIPPET_MATCH_END, "</mark>")
+            )
+            post.search_snippet = Markup(snippet)
+        posts.append(post)
+    return posts
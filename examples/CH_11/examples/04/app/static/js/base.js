@@ -13,3 +13,38 @@
         toast.show()
     })
 }())
+
+/**
+ * Formats the ISO-8601 times the server emits with the
+ * datetime_client_format setting on in the browser's own
+ * timezone, using the strftime format in the time element's
+ * data-format attribute. It runs on the page when it loads
+ * and on the fragments other scripts add to the page.
+ *
+ * @param {ParentNode} root - The element or fragment to format the times in
+ */
+window.formatLocalTimes = (function() {
+    const pad = (value) => String(value).padStart(2, "0")
+    const directives = {
+        "Y": (date) => date.getFullYear(),
+        "m": (date) => pad(date.getMonth() + 1),
+        "d": (date) => pad(date.getDate()),
+        "H": (date) => pad(date.getHours()),
+        "M": (date) => pad(date.getMinutes()),
+        "S": (date) => pad(date.getSeconds()),
+        "%": () => "%"
+    }
+    return (root = document) => {
+        var timeElements = [].slice.call(root.querySelectorAll('time[data-format]'))
+        timeElements.map((timeElement) => {
+            const date = new Date(timeElement.getAttribute("datetime"))
+            if (isNaN(date)) {
+                return
+            }
+            timeElement.textContent = timeElement.dataset.format.replace(/%(.)/g, (match, directive) => {
+                return directive in directives ? directives[directive](date) : match
+            })
+        })
+    }
+}())
+window.formatLocalTimes()